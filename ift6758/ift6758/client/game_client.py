@@ -1,15 +1,29 @@
 import pandas as pd
 import numpy as np
 
-from ift6758.data import pd_make_df
-from ift6758.data.fetch_data import FetchData
+from ift6758.data import fetch_data, pd_make_df
+from ift6758.data.fetch_data import FetchData, live_game
+from ift6758.data.feature_cache import FeatureCache, featurize
 
 class GameClient:
-    def __init__(self) -> None:
+    def __init__(self, loader=None, use_cache=None, feature_cache=None) -> None:
+        """
+        loader: function (gameId, use_cache) -> events dataframe, used to load the games.
+            Defaults to pd_make_df.create_dataframe_from_game; can be replaced by a cached
+            version shared between clients (e.g. the streamlit app).
+        use_cache: whether the cached feeds are used. If None, they are used for the games
+            before 2022 only (see fetch_data.live_game); False treats every game as live (e.g.
+            games of a replay server, also with NHL_FORCE_LIVE=1).
+        feature_cache: FeatureCache from which the features of finished games are read, and to
+            which they are written when a game ends. Defaults to FeatureCache().
+        """
         self.gameId = 0
         self.last_eventIdx = None
         self.game_ended = None
         self.model_name = None
+        self.loader = pd_make_df.create_dataframe_from_game if loader is None else loader
+        self.use_cache = use_cache
+        self.feature_cache = FeatureCache() if feature_cache is None else feature_cache
         
         
     def process_query(self, gameId, return_raw=False, model_name="xgboost-base-all-features"):
@@ -24,12 +38,9 @@ class GameClient:
         "xgboost-best-all-features"
         "xgboost-base-all-features"
         """
-        full_model = True
-        if model_name == "xgboost-best-select-features":
-            full_model = False
-        
-        game_year = int(str(gameId)[:4])
-        use_cache = True if game_year < 2022 else False
+        use_cache = self.use_cache
+        if use_cache is None:
+            use_cache = not live_game(gameId)
 
         if self.model_name != model_name: self.gameId = 0
         self.model_name = model_name
@@ -37,8 +48,16 @@ class GameClient:
         # game has already been fully processed
         if self.gameId == gameId and self.game_ended: return None 
         
+        # finished game already featurized: no feed to parse (but replayed games are not finished)
+        if not return_raw and not fetch_data.FORCE_LIVE:
+            cached = self.feature_cache.get(gameId, model_name)
+            if cached is not None:
+                return self.process_cached(gameId, cached)
+
         # load game
-        df = pd_make_df.create_dataframe_from_game(gameId, use_cache=use_cache)
+        df = self.loader(gameId, use_cache=use_cache)
+        if df is None: return None
+        game_df = df
         
         # if same game, slice. last_eventIdx was set in the last call
         if self.gameId == gameId:
@@ -47,12 +66,14 @@ class GameClient:
             
         self.game_ended = "GAME_END" in df["eventType"].values
         self.last_eventIdx = df.iloc[-1].eventIdx
+        if self.game_ended:
+            self.feature_cache.put(gameId, featurize(game_df))
         
         filtered = pd_make_df.full(df)
         
         if len(filtered) == 0: return None
         
-        returned_df = pd_make_df.aug3(filtered, full_model)
+        returned_df = pd_make_df.aug3(filtered, model_name=model_name)
         returned_df["team"] = filtered["teamTriCode"]
         
         team_col = returned_df.pop("team")
@@ -64,6 +85,18 @@ class GameClient:
         self.gameId = gameId
         if len(returned_df) == 0: return None
         else: return df if return_raw else returned_df
+
+    def process_cached(self, gameId, cached):
+        """
+        Same as process_query, from the cached features of a finished game.
+        """
+        if self.gameId == gameId:
+            cached = cached[cached["eventIdx"] > self.last_eventIdx]
+        self.gameId = gameId
+        self.game_ended = True
+        if len(cached) == 0: return None
+        self.last_eventIdx = cached["eventIdx"].iloc[-1]
+        return cached.drop(columns="eventIdx")
     
 
 
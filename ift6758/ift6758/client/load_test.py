@@ -0,0 +1,312 @@
+"""
+Closed-loop load test of the serving app: each client sends a request, waits for the response, and
+sends the next one. The requests are a mix of /predict with live-game payloads (a few shots) and
+with season payloads (thousands of shots), /download_registry_model and /logs. The number of
+clients is increased level by level. Each level reports the throughput, the p50/p95/p99 latencies
+and the error rate, which are used to size the gunicorn workers of the serving container and to
+catch throughput regressions.
+
+Against a running container (docker-compose up serving):
+
+    $ python -m ift6758.client.load_test --url http://localhost:5000 --concurrency 1 2 4 8 16
+
+Against a local app started by the harness, with 4 gunicorn workers. The model is trained on
+random rows and saved in a temporary models folder, so no Comet access is needed:
+
+    $ python -m ift6758.client.load_test --serve --workers 4 --concurrency 1 4 16 --duration 20
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit
+
+import numpy as np
+import requests
+
+from ift6758.client.serving_client import ServingClient
+from ift6758.data.feature_schema import DEFAULT_MODEL, MODEL_FILES, get_columns
+
+logger = logging.getLogger(__name__)
+
+SERVING_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../../serving"))
+
+# Share of each kind of request
+DEFAULT_MIX = {
+    'predict_live': 0.85,
+    'predict_season': 0.05,
+    'logs': 0.08,
+    'download_registry_model': 0.02,
+}
+
+# Shots of the live game payloads (new shots since the last poll)
+LIVE_ROWS = (1, 10)
+
+# Ranges of the numerical features; the other columns are the one hot encodings below
+FEATURE_RANGES = {
+    'periodTimeSec': (0, 1200),
+    'period': (1, 4),
+    'coordinate_x': (-99, 99),
+    'coordinate_y': (-42, 42),
+    'distanceFromGoal': (0, 190),
+    'shotAngle': (-np.pi / 2, np.pi / 2),
+    'lastEventCoord_x': (-99, 99),
+    'lastEventCoord_y': (-42, 42),
+    'timeDifference': (0, 60),
+    'distanceDifference': (0, 190),
+    'rebound': (0, 2),
+    'shotAngleDifference': (-np.pi, np.pi),
+    'speed': (0, 100),
+}
+INTEGER_FEATURES = {'period', 'rebound'}
+ONE_HOT_GROUPS = [
+    ['Backhand', 'Deflected', 'Slap Shot', 'Snap Shot', 'Tip-In', 'Wrap-around', 'Wrist Shot'],
+    ['BLOCKED_SHOT', 'FACEOFF', 'GIVEAWAY', 'GOAL', 'HIT', 'MISSED_SHOT', 'PENALTY', 'SHOT', 'TAKEAWAY'],
+]
+
+
+def feature_rows(features: list, n: int, rng):
+    """
+    Random shots with the given features (ServingClient.features): numerical features drawn in
+    their range, and one column set to 1 in each one hot encoding.
+    Returns:
+        X: array (n, len(features))
+    """
+    X = np.zeros((n, len(features)))
+    for j, feature in enumerate(features):
+        if feature in FEATURE_RANGES:
+            low, high = FEATURE_RANGES[feature]
+            if feature in INTEGER_FEATURES:
+                X[:, j] = rng.integers(low, high, size=n)
+            else:
+                X[:, j] = rng.uniform(low, high, size=n)
+    for group in ONE_HOT_GROUPS:
+        columns = [features.index(c) for c in group if c in features]
+        if columns:
+            X[np.arange(n), rng.choice(columns, size=n)] = 1
+    return X
+
+
+def make_requests(features: list, model: str, season_rows=5000, n_live=50, seed=0):
+    """
+    Requests of each kind of DEFAULT_MIX, with their JSON bodies encoded once, so that the
+    clients spend their time waiting for the server rather than serializing.
+    Returns:
+        requests: dict of kind -> list of (method, path, body bytes or None)
+    """
+    rng = np.random.default_rng(seed)
+
+    def predict_body(n):
+        return json.dumps({'features': features, 'values': feature_rows(features, n, rng).tolist()}).encode()
+
+    return {
+        'predict_live': [("POST", "/predict", predict_body(rng.integers(*LIVE_ROWS, endpoint=True)))
+                         for _ in range(n_live)],
+        'predict_season': [("POST", "/predict", predict_body(season_rows))],
+        'logs': [("GET", "/logs", None)],
+        'download_registry_model': [("POST", "/download_registry_model", json.dumps({
+            'workspace': 'ift-6758-projet-quipe-13', 'model': model, 'version': '1.0.0'
+        }).encode())],
+    }
+
+
+def client(base_url: str, reqs: dict, mix: dict, end: float, seed: int, records: list, timeout=60):
+    """Sends requests one after the other until end, appends (kind, latency, ok) to records."""
+    rng = np.random.default_rng(seed)
+    kinds = list(mix)
+    weights = np.array([mix[kind] for kind in kinds], dtype=float)
+    session = requests.Session()
+    headers = {'Content-Type': 'application/json'}
+    while time.perf_counter() < end:
+        kind = kinds[rng.choice(len(kinds), p=weights / weights.sum())]
+        method, path, body = reqs[kind][rng.integers(len(reqs[kind]))]
+        start = time.perf_counter()
+        try:
+            response = session.request(method, base_url + path, data=body, headers=headers, timeout=timeout)
+            ok = response.status_code < 400
+        except requests.RequestException:
+            ok = False
+        records.append((kind, time.perf_counter() - start, ok))
+
+
+def summarize(records: list, elapsed: float):
+    """Throughput, latency percentiles (ms) and error rate of a list of (kind, latency, ok)."""
+    if not records:
+        return {'requests': 0, 'throughput': 0.0, 'error_rate': 0.0}
+    latencies = np.array([latency for _, latency, _ in records]) * 1000
+    errors = sum(1 for _, _, ok in records if not ok)
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {
+        'requests': len(records),
+        'throughput': len(records) / elapsed,
+        'p50': p50, 'p95': p95, 'p99': p99,
+        'error_rate': errors / len(records),
+    }
+
+
+def run_level(base_url: str, reqs: dict, mix: dict, concurrency: int, duration: float, warmup=1.0):
+    """
+    Runs concurrency clients for warmup + duration seconds; the requests of the warmup are not counted.
+    Returns:
+        stats: summarize of all the requests, and of each kind in 'kinds'
+    """
+    records = [[] for _ in range(concurrency)]
+    start = time.perf_counter()
+    end = start + warmup + duration
+    threads = [threading.Thread(target=client, args=(base_url, reqs, mix, end, i, records[i]))
+               for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    time.sleep(warmup)
+    # the records of the warmup are dropped, the clients keep appending to their list
+    counted_from = [len(r) for r in records]
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start - warmup
+    counted = [record for r, n in zip(records, counted_from) for record in r[n:]]
+
+    stats = {'concurrency': concurrency, **summarize(counted, elapsed)}
+    stats['kinds'] = {
+        kind: summarize([r for r in counted if r[0] == kind], elapsed) for kind in mix
+    }
+    return stats
+
+
+def host_port(url: str):
+    """Host and port of a URL, with the default port of its scheme if it has none (e.g. http://serving)."""
+    parts = urlsplit(url if "://" in url else "http://" + url)
+    return parts.hostname, parts.port or (443 if parts.scheme == "https" else 80)
+
+
+def run(base_url: str, concurrency_levels: list, duration=10.0, mix=None, model=DEFAULT_MODEL, season_rows=5000):
+    """
+    Load test of the serving app at base_url, one level per number of clients.
+    Returns:
+        levels: list of run_level stats
+    """
+    mix = DEFAULT_MIX if mix is None else mix
+    if set(mix) - set(DEFAULT_MIX):
+        raise ValueError(f"Unknown kinds of requests {sorted(set(mix) - set(DEFAULT_MIX))}, valid kinds are {list(DEFAULT_MIX)}")
+    # the payloads are validated against the current model, which must be the tested one
+    host, port = host_port(base_url)
+    serving_client = ServingClient(ip=host, port=port)
+    response = serving_client.download_registry_model('ift-6758-projet-quipe-13', model, '1.0.0')
+    if not response.ok:
+        raise RuntimeError(f"Could not load the model {model}: {response.text}")
+    reqs = make_requests(serving_client.features, model, season_rows)
+    levels = []
+    for concurrency in concurrency_levels:
+        stats = run_level(base_url, reqs, mix, concurrency, duration)
+        print(format_level(stats), flush=True)
+        levels.append(stats)
+    return levels
+
+
+def format_level(stats: dict):
+    lines = ["{:>4} clients  {:8.1f} req/s  p50 {:8.1f} ms  p95 {:8.1f} ms  p99 {:8.1f} ms  errors {:6.2%}".format(
+        stats['concurrency'], stats['throughput'], stats.get('p50', 0), stats.get('p95', 0), stats.get('p99', 0),
+        stats['error_rate'])]
+    for kind, s in stats['kinds'].items():
+        if s['requests']:
+            lines.append("      {:<24} {:6d} req  p50 {:8.1f} ms  p95 {:8.1f} ms  p99 {:8.1f} ms  errors {:6.2%}".format(
+                kind, s['requests'], s['p50'], s['p95'], s['p99'], s['error_rate']))
+    return "\n".join(lines)
+
+
+def save_random_model(models_dir: str, model=DEFAULT_MODEL, n_rows=5000, seed=0):
+    """
+    Trains an XGBClassifier with the features of the model on random shots (goals far from the
+    net are rare), and saves it in the models folder under the name the serving app expects.
+    """
+    import xgboost
+
+    rng = np.random.default_rng(seed)
+    features = get_columns(model)
+    X = feature_rows(features, n_rows, rng)
+    distance = X[:, features.index('distanceFromGoal')]
+    y = rng.random(n_rows) < 0.3 * np.exp(-distance / 30)
+    classifier = xgboost.XGBClassifier(n_estimators=100, max_depth=4)
+    classifier.fit(X, y)
+    os.makedirs(models_dir, exist_ok=True)
+    classifier.save_model(os.path.join(models_dir, MODEL_FILES[model]))
+
+
+def serve_local(port=5000, workers=1, model=DEFAULT_MODEL, backend=None, serving_dir=SERVING_DIR, timeout=60):
+    """
+    Starts the serving app in a subprocess, with a model trained by save_random_model in a temporary
+    models folder: with gunicorn and the given number of workers when it is installed, with the
+    threaded flask development server otherwise.
+    Args:
+        backend (str): inference backend of the model ('xgboost' or 'compiled'), see serving/app.py
+    Returns:
+        process: the server process, to terminate at the end of the test
+        tmp: the temporary folder of the model and the logs, to delete at the end of the test
+    """
+    tmp = tempfile.mkdtemp(prefix="load_test_")
+    process = None
+    try:
+        save_random_model(os.path.join(tmp, "models"), model)
+        env = dict(os.environ, MODELS_DIR=os.path.join(tmp, "models"), FLASK_LOG=os.path.join(tmp, "flask.log"))
+        if backend is not None:
+            env["MODEL_BACKENDS"] = f"{model}={backend}"
+        if shutil.which("gunicorn"):
+            command = ["gunicorn", "--bind", f"127.0.0.1:{port}", "--workers", str(workers), "app:app", "--timeout", "600"]
+        else:
+            logger.warning("gunicorn is not installed, the app is served by the flask development server (one process)")
+            command = [sys.executable, "-m", "flask", "--app", "app", "run", "--port", str(port), "--with-threads"]
+        process = subprocess.Popen(command, cwd=serving_dir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"The serving app exited with code {process.returncode}")
+            try:
+                if requests.get(f"http://127.0.0.1:{port}/hello", timeout=1).ok:
+                    return process, tmp
+            except requests.RequestException:
+                pass
+            time.sleep(0.2)
+        raise RuntimeError(f"The serving app did not start in {timeout}s")
+    except BaseException:
+        # nothing to clean up for the caller if the app did not start
+        if process is not None:
+            process.terminate()
+            process.wait()
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Closed-loop load test of the serving app.")
+    parser.add_argument("--url", default="http://127.0.0.1:5000", help="serving app to test")
+    parser.add_argument("--serve", action="store_true", help="start a local app with a random model at --url")
+    parser.add_argument("--workers", type=int, default=1, help="--serve: gunicorn workers")
+    parser.add_argument("--backend", choices=["xgboost", "compiled"], default=None, help="--serve: inference backend")
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 16], help="clients of each level")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of each level")
+    parser.add_argument("--season-rows", type=int, default=5000, help="shots of the season payloads")
+    parser.add_argument("--mix", type=json.loads, default=None,
+                        help='share of each kind of request, e.g. \'{"predict_live": 0.9, "logs": 0.1}\'')
+    parser.add_argument("--output", default=None, help="write the stats of the levels to this json file")
+    args = parser.parse_args()
+
+    process, tmp = None, None
+    if args.serve:
+        process, tmp = serve_local(host_port(args.url)[1], args.workers, args.model, args.backend)
+    try:
+        levels = run(args.url, args.concurrency, args.duration, args.mix, args.model, args.season_rows)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+            shutil.rmtree(tmp, ignore_errors=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(levels, f, indent=2)
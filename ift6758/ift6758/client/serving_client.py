@@ -4,6 +4,8 @@ import pandas as pd
 import logging
 import numpy as np
 
+from ift6758.data.feature_schema import DEFAULT_MODEL, get_columns
+
 logger = logging.getLogger(__name__)
 
 class ServingClient:
@@ -11,16 +13,12 @@ class ServingClient:
         self.base_url = f"http://{ip}:{port}"
         logger.info(f"Initializing client; base URL: {self.base_url}")
 
+        # The server starts with the default model; the features follow the model schema
+        # unless they are given explicitly.
+        self.model = DEFAULT_MODEL
+        self.fixed_features = features is not None
         if features is None:
-            features = [
-                'periodTimeSec', 'period', 'coordinate_x', 'coordinate_y',
-                'distanceFromGoal', 'shotAngle', 'lastEventCoord_x', 'lastEventCoord_y',
-                'timeDifference', 'distanceDifference', 'rebound',
-                'shotAngleDifference', 'speed', 'Backhand', 'Deflected', 'Slap Shot',
-                'Snap Shot', 'Tip-In', 'Wrap-around', 'Wrist Shot', 'BLOCKED_SHOT',
-                'FACEOFF', 'GIVEAWAY', 'GOAL', 'HIT', 'MISSED_SHOT', 'SHOT',
-                'TAKEAWAY', 'PENALTY'
-            ]
+            features = get_columns(self.model)
         self.features = features
 
 
@@ -35,14 +33,17 @@ class ServingClient:
         """
         logger.info("Pinging game")
         if X is not None:
-            X = X.drop(columns=['isGoal', 'team'], errors='ignore')
+            # Exact matrix expected by the model, in the order of its schema
+            X = X[self.features]
             logger.info(f"Input DataFrame shape: {X.shape}")
             X_dict = {}
-            X_values = X.values.tolist()
-            X_dict['values'] = X_values
+            X_dict['features'] = self.features
+            X_dict['values'] = X.values.tolist()
             pred = requests.post(url=self.base_url + "/predict", json=X_dict)
             try:
                 output = pred.json()
+                if not pred.ok:
+                    raise ValueError(output)
                 logger.info('Response DataFrame obtained') # length: ' + str(len(output)))
                 return pd.DataFrame(output)
             except Exception as e:
@@ -54,13 +55,38 @@ class ServingClient:
         logger.info("Returned output is None.")
         return None
 
+    def predict_game(self, game_id: str, since_eventIdx: int = None, model: str = None) -> dict:
+        """
+        Gets the predictions of the shots of a game, fetched and featurized by the service
+        (see /predict_game in serving/app.py), instead of sending the features.
+
+        Args:
+            game_id (str): The game ID
+            since_eventIdx (int): only return the shots after this event (e.g. the last shot
+                received), all the shots if None
+            model (str): The model name (the current model of the service if None)
+        Returns:
+            dict with the shots and their probability, and the xG and goals of each team,
+            or None if the request failed
+        """
+        params = {'game_id': game_id}
+        if since_eventIdx is not None:
+            params['since_eventIdx'] = int(since_eventIdx)
+        if model is not None:
+            params['model'] = model
+        response = requests.get(self.base_url + "/predict_game", params=params)
+        if not response.ok:
+            logger.info(f"Error in game prediction: {response.text}")
+            return None
+        return response.json()
+
     def logs(self) -> dict:
         """Get server logs"""
         response = requests.get(self.base_url+"/logs")
         logger.info("Accessing logs")
         return response.json()
 
-    def download_registry_model(self, workspace: str, model: str, version: str) -> dict:
+    def download_registry_model(self, workspace: str, model: str, version: str, backend: str = None) -> dict:
         """
         Triggers a "model swap" in the service; the workspace, model, and model version are
         specified and the service looks for this model in the model registry and tries to
@@ -74,6 +100,8 @@ class ServingClient:
             workspace (str): The Comet ML workspace
             model (str): The model in the Comet ML registry to download
             version (str): The model version to download
+            backend (str): 'xgboost' or 'compiled' (NumPy trees, faster for small batches), the
+                backend already set for the model in the service if None
         """
         logger.info("Getting model.")
         model_dict = {
@@ -81,7 +109,24 @@ class ServingClient:
             'model': model,
             'version': version
         }
+        if backend is not None:
+            model_dict['backend'] = backend
         logger.info(f"Downloading the following model: {model_dict}")
         response = requests.post(self.base_url + "/download_registry_model", json=model_dict)
         logger.info(response.text)
+        if response.ok and not self.fixed_features:
+            self.model = model
+            self.features = get_columns(model)
         return response
+
+    def get_schema(self, model: str = None) -> dict:
+        """
+        Gets the feature schema of a model from the service (the current model if None).
+
+        Args:
+            model (str): The model name
+        """
+        params = {} if model is None else {'model': model}
+        response = requests.get(self.base_url + "/features", params=params)
+        logger.info("Accessing feature schema")
+        return response.json()
@@ -0,0 +1,197 @@
+"""
+Expected goals (xG) and goals minus xG of scored shots, per team, per game, per period and per
+shooter. The aggregates are kept as arrays indexed by integer codes, updated with np.bincount, so
+that the shots of live games can be added as they come (GameClient returns only the new shots).
+
+Aggregate a season of cached, scored shots:
+
+    >>> shots = FeatureCache().season_features(2016, model_name, game_ids, info=True)
+    >>> shots["xG"] = booster.inplace_predict(shots[get_columns(model_name)].values)
+    >>> agg = XGAggregator()
+    >>> agg.update(shots)
+    >>> agg.leaderboard("shooter", n=10, min_shots=50)
+"""
+import numpy as np
+import pandas as pd
+
+
+# Key columns of each level of aggregation
+LEVELS = {
+    'team': ['team'],
+    'game': ['gameId', 'team'],
+    'period': ['gameId', 'team', 'period'],
+    'shooter': ['shooterId'],
+}
+
+# Bounds of the codes combined into the int64 keys of the game and period levels
+MAX_TEAMS = 64
+MAX_PERIODS = 16
+
+
+class Encoder:
+    def __init__(self):
+        """Incremental encoding of values to codes 0, 1, 2, ... in order of appearance."""
+        self.codes = {}
+        self.values = []
+
+    def __len__(self):
+        return len(self.values)
+
+    def encode(self, values: np.ndarray):
+        """
+        Codes of the values, new values get new codes. The values are factorized first, so that
+        only the distinct values of the batch are looked up. Missing values (None, NaN) are not
+        encoded: their code is -1.
+        Returns:
+            codes: int64 array, and the positions of the first occurrences of the new values
+        """
+        # missing values get the code -1 from factorize, which is its default in every pandas
+        # version (na_sentinel=-1 before 1.5, use_na_sentinel=True since)
+        batch_codes, uniques = pd.factorize(values)
+        # the last entry is the code of the missing values, looked up by batch code -1
+        lookup = np.full(len(uniques) + 1, -1, dtype=np.int64)
+        new = []
+        for i, value in enumerate(uniques):
+            code = self.codes.get(value)
+            if code is None:
+                code = self.codes[value] = len(self.values)
+                self.values.append(value)
+                new.append(i)
+            lookup[i] = code
+        codes = lookup[batch_codes]
+        first = np.empty(0, dtype=np.int64)
+        if new:
+            # factorize numbers the distinct values in order of first occurrence
+            positions = np.flatnonzero(batch_codes >= 0)
+            first = positions[np.unique(batch_codes[positions], return_index=True)[1][new]]
+        return codes, first
+
+
+class XGAggregator:
+    def __init__(self):
+        """
+        Number of shots, goals, xG (sum of the goal probabilities) and goals minus xG of scored
+        shots, at each level of LEVELS. Adding the same shot twice counts it twice.
+        """
+        self.teams = Encoder()
+        self.encoders = {level: Encoder() for level in LEVELS}
+        # key values of each code, in code order, and the last team and name of the shooters
+        self.keys = {level: [] for level in LEVELS}
+        self.shooter_info = {'shooter': [], 'team': []}
+        self.sums = {level: np.zeros((3, 0)) for level in LEVELS}  # rows: shots, goals, xG
+        self.n_shots = 0
+
+    def level_keys(self, level: str, columns: dict, team_codes: np.ndarray):
+        """int64 key of each shot at the level, -1 if the shot has no key (e.g. no shooter or team)."""
+        if level == 'team':
+            return team_codes
+        if level == 'shooter':
+            return columns['shooterId']
+        game_keys = columns['gameId'] * MAX_TEAMS + team_codes
+        if level == 'period':
+            game_keys = game_keys * MAX_PERIODS + columns['period']
+        # a missing team (code -1) would otherwise give the key of another team
+        return np.where(team_codes >= 0, game_keys, -1)
+
+    def update(self, shots: pd.DataFrame, xg=None):
+        """
+        Adds scored shots to the aggregates.
+        Args:
+            shots (DataFrame): shots with the columns gameId, team, period, isGoal and, for the
+                shooter level, shooterId and shooter (see FeatureCache.season_features with info=True)
+            xg: goal probability of each shot (the xG column of shots if None)
+        """
+        if len(shots) == 0:
+            return
+        # numpy columns: indexing pandas objects for every level would dominate small live updates
+        columns = {
+            'gameId': shots['gameId'].to_numpy().astype(np.int64),
+            'team': shots['team'].to_numpy(),
+            'period': shots['period'].to_numpy(dtype=np.int64),
+        }
+        if 'shooterId' in shots.columns:
+            columns['shooterId'] = shots['shooterId'].astype("Int64").fillna(-1).to_numpy(dtype=np.int64)
+            columns['shooter'] = shots['shooter'].to_numpy()
+        xg = shots['xG'].to_numpy(dtype=np.float64) if xg is None else np.asarray(xg, dtype=np.float64)
+        goals = shots['isGoal'].to_numpy(dtype=np.float64)
+        team_codes, _ = self.teams.encode(columns['team'])
+
+        for level in LEVELS:
+            if level == 'shooter' and 'shooterId' not in columns:
+                continue
+            keys = self.level_keys(level, columns, team_codes)
+            valid = keys >= 0
+            if not valid.all():
+                keys, rows = keys[valid], np.flatnonzero(valid)
+            else:
+                rows = None
+            codes, first = self.encoders[level].encode(keys)
+            new_rows = first if rows is None else rows[first]
+            self.add_keys(level, columns, new_rows, codes, rows)
+
+            n = len(self.encoders[level])
+            weights = [None, goals, xg] if rows is None else [None, goals[rows], xg[rows]]
+            sums = self.sums[level]
+            if sums.shape[1] < n:
+                # grow by doubling, so that live updates do not reallocate every time
+                grown = np.zeros((3, max(n, 2 * sums.shape[1])))
+                grown[:, :sums.shape[1]] = sums
+                self.sums[level] = sums = grown
+            for i, w in enumerate(weights):
+                sums[i, :n] += np.bincount(codes, weights=w, minlength=n)
+        self.n_shots += len(shots)
+
+    def add_keys(self, level: str, columns: dict, new_rows: np.ndarray, codes: np.ndarray, rows):
+        """Stores the key values of the new codes of the level (and the shooters info)."""
+        if len(new_rows):
+            # gameId is stored as str, as in the shots
+            keys = [columns[column][new_rows].astype(str) if column == 'gameId' else columns[column][new_rows]
+                    for column in LEVELS[level]]
+            self.keys[level].extend(zip(*[key.tolist() for key in keys]))
+        if level == 'shooter':
+            info = self.shooter_info
+            n = len(self.encoders[level])
+            info['shooter'].extend([None] * (n - len(info['shooter'])))
+            info['team'].extend([None] * (n - len(info['team'])))
+            # last name and team of each shooter of the batch (a player can be traded)
+            positions = np.arange(len(columns['team'])) if rows is None else rows
+            unique_codes, last = np.unique(codes[::-1], return_index=True)
+            last = positions[len(codes) - 1 - last]
+            names, teams = columns['shooter'][last], columns['team'][last]
+            for code, name, team in zip(unique_codes.tolist(), names, teams):
+                info['shooter'][code] = name
+                info['team'][code] = team
+
+    def table(self, level: str):
+        """
+        Aggregates of a level.
+        Returns:
+            df: dataframe with the key columns of the level (and shooter, team for the shooter
+                level), shots, goals, xG and goals_minus_xG
+        """
+        if level not in LEVELS:
+            raise ValueError(f"Unknown level {level}, valid levels are {list(LEVELS)}")
+        n = len(self.encoders[level])
+        df = pd.DataFrame(self.keys[level], columns=LEVELS[level])
+        if level == 'shooter':
+            df['shooter'] = self.shooter_info['shooter'][:n]
+            df['team'] = self.shooter_info['team'][:n]
+        shots, goals, xg = self.sums[level][:, :n]
+        df['shots'] = shots.astype(np.int64)
+        df['goals'] = goals.astype(np.int64)
+        df['xG'] = xg
+        df['goals_minus_xG'] = goals - xg
+        return df
+
+    def leaderboard(self, level='shooter', by='goals_minus_xG', n=20, min_shots=1, ascending=False):
+        """
+        Top n rows of table(level) by the given column, among the keys with at least min_shots.
+        """
+        n_codes = len(self.encoders[level])
+        shots, goals, xg = self.sums[level][:, :n_codes]
+        values = {'shots': shots, 'goals': goals, 'xG': xg, 'goals_minus_xG': goals - xg}[by]
+        # ranked on the arrays, without sorting the table
+        candidates = np.flatnonzero(shots >= min_shots)
+        order = np.argsort(values[candidates] if ascending else -values[candidates], kind="stable")
+        top = candidates[order[:n]]
+        return self.table(level).iloc[top].reset_index(drop=True)
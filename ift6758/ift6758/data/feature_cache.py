@@ -0,0 +1,281 @@
+import glob
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+import pandas as pd
+
+from ift6758.data import feature_schema, fetch_data, pd_make_df
+from ift6758.data.feature_schema import get_columns
+
+
+FEATURES_PATH = os.environ.get(
+    "NHL_FEATURES_DIR", os.path.abspath(os.path.join(os.path.dirname(__file__), "../../../data/features/"))
+)
+
+# Model whose schema contains every feature: the cached matrices are stored with its columns
+ALL_FEATURES_MODEL = 'xgboost-best-all-features'
+
+# Game IDs: season (4 digits), game type (2 digits) and game number (4 digits)
+GAME_ID = re.compile(r"^\d{10}$")
+
+# Seconds during which the features of a live game are shared before its feed is fetched again
+LIVE_TTL = float(os.environ.get("NHL_LIVE_TTL", 5))
+
+# Columns of the shots that are not features, cached for the aggregations (see aggregation.py)
+INFO_COLUMNS = ["shooterId", "shooter", "goalieId", "goalie"]
+
+
+def feature_version():
+    """
+    Hash of the featurization code (pd_make_df, feature_schema, and this module for featurize and
+    INFO_COLUMNS): the cached features are stored under this version, so that they are recomputed
+    whenever the code changes.
+    """
+    h = hashlib.sha1()
+    for path in (pd_make_df.__file__, feature_schema.__file__, __file__):
+        with open(path, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()[:12]
+
+
+def featurize(df: pd.DataFrame):
+    """
+    Computes the feature matrix of the shots of a game from its events dataframe
+    (create_dataframe_from_game), with every feature of the schemas.
+    Returns:
+        X: dataframe with columns eventIdx, team, isGoal, the features of ALL_FEATURES_MODEL and
+            the INFO_COLUMNS
+    """
+    filtered = pd_make_df.full(df)
+    X = pd_make_df.aug3(filtered, model_name=ALL_FEATURES_MODEL)
+    X.insert(0, "team", filtered.loc[X.index, "teamTriCode"].values)
+    X.insert(0, "eventIdx", filtered.loc[X.index, "eventIdx"].values)
+    X[INFO_COLUMNS] = filtered.loc[X.index, INFO_COLUMNS]
+    return X.reset_index(drop=True)
+
+
+def select_model_columns(X: pd.DataFrame, model_name: str, info=False):
+    """
+    Columns eventIdx, team, isGoal and the features of the model, from a cached matrix,
+    followed by the INFO_COLUMNS if info is True.
+    """
+    return X[["eventIdx", "team", "isGoal"] + get_columns(model_name) + (INFO_COLUMNS if info else [])]
+
+
+class FeatureCache:
+    def __init__(self, path=None, version=None):
+        """
+        Persistent cache of the feature matrices of finished games, one parquet file per game,
+        at path/<featurization version>/<season>/<game_id>.parquet. Only the current version
+        of the featurization code is read, so changing the feature code invalidates the cache.
+        Args:
+            path: root folder of the cache (FEATURES_PATH if None)
+            version: featurization version (feature_version() if None)
+        """
+        self.path = FEATURES_PATH if path is None else path
+        self.version = feature_version() if version is None else version
+
+    def game_path(self, game_id: str):
+        game_id = str(game_id)
+        return os.path.join(self.path, self.version, game_id[:4], "{}.parquet".format(game_id))
+
+    def get(self, game_id: str, model_name=ALL_FEATURES_MODEL, info=False):
+        """
+        Returns the cached feature matrix of a game (see select_model_columns), or None.
+        """
+        try:
+            X = pd.read_parquet(self.game_path(game_id))
+        except (FileNotFoundError, OSError):
+            return None
+        return select_model_columns(X, model_name, info)
+
+    def put(self, game_id: str, X: pd.DataFrame):
+        """
+        Stores the feature matrix of a finished game (see featurize). The file is written
+        atomically, so concurrent readers never see a partial file.
+        """
+        path = self.game_path(game_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        os.close(fd)
+        try:
+            X.to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def game_features(self, game_id: str, model_name=ALL_FEATURES_MODEL, use_cache=True, info=False):
+        """
+        Feature matrix of a game: read from the cache if possible, otherwise computed from its
+        feed and cached if the game is finished.
+        Returns:
+            X: see select_model_columns, or None if the game has no play
+        """
+        X = self.get(game_id, model_name, info)
+        if X is not None:
+            return X
+        df = pd_make_df.create_dataframe_from_game(game_id, use_cache=use_cache)
+        if df is None:
+            return None
+        X = featurize(df)
+        if "GAME_END" in df["eventType"].values:
+            self.put(game_id, X)
+        return select_model_columns(X, model_name, info)
+
+    def season_features(self, year: int, model_name=ALL_FEATURES_MODEL, game_ids=None, info=False):
+        """
+        Feature matrices of the games of a season, concatenated, with a gameId column.
+        Args:
+            year (int): first year of the season
+            model_name (str): model whose features are returned
+            game_ids (list): games to load (computed and cached if needed); if None, only the
+                games already in the cache are read
+            info (bool): also return the INFO_COLUMNS (shooter and goalie)
+        Returns:
+            X: dataframe with columns gameId, eventIdx, team, isGoal and the features of the model
+        """
+        if game_ids is None:
+            files = sorted(glob.glob(os.path.join(self.path, self.version, str(year), "*.parquet")))
+            game_ids = [os.path.basename(file)[:-len(".parquet")] for file in files]
+        frames = []
+        for game_id in game_ids:
+            X = self.game_features(game_id, model_name, info=info)
+            if X is not None:
+                frames.append(X.assign(gameId=str(game_id)))
+        if not frames:
+            return pd.DataFrame(columns=["gameId", "eventIdx", "team", "isGoal"] + get_columns(model_name)
+                                + (INFO_COLUMNS if info else []))
+        X = pd.concat(frames, ignore_index=True)
+        return X[["gameId"] + list(X.columns[:-1])]
+
+    def prune(self):
+        """Deletes the cached features of the other featurization versions."""
+        for version_path in glob.glob(os.path.join(self.path, "*")):
+            if os.path.basename(version_path) != self.version:
+                shutil.rmtree(version_path, ignore_errors=True)
+
+
+class SharedGameFeatures:
+    def __init__(self, cache=None, live_ttl=LIVE_TTL, max_games=256):
+        """
+        In-memory features of the games requested recently, shared by the threads of a process
+        (e.g. the requests of the serving app): concurrent requests for the same game wait for a
+        single fetch and featurization. Finished games are read from (and written to) the
+        FeatureCache; live games are featurized again once their features are live_ttl seconds old.
+        Args:
+            cache (FeatureCache): FeatureCache() if None
+            live_ttl (float): seconds during which the features of a live game are reused
+            max_games (int): number of games kept in memory (least recently used are dropped)
+        """
+        self.cache = FeatureCache() if cache is None else cache
+        self.live_ttl = live_ttl
+        self.max_games = max_games
+        self.games = OrderedDict()  # game ID -> GameFeatures
+        self.lock = threading.Lock()
+        # lock of each game being loaded, with its number of users: evicted when unused
+        self.game_locks = {}
+
+    def get(self, game_id: str):
+        """
+        Features of every shot of the game, with the INFO_COLUMNS (see featurize).
+        Returns:
+            entry: GameFeatures, or None if the game has no play (e.g. unknown game)
+        Raises:
+            ValueError: game_id is not a game ID (10 digits)
+        """
+        game_id = str(game_id)
+        if not GAME_ID.match(game_id):
+            raise ValueError(f"Invalid game ID {game_id}, expected 10 digits (e.g. 2022020001)")
+        entry = self.lookup(game_id)
+        if entry is not None:
+            return entry
+        with self.lock:
+            game_lock = self.game_locks.setdefault(game_id, [threading.Lock(), 0])
+            game_lock[1] += 1
+        try:
+            with game_lock[0]:
+                # computed by another request while this one waited
+                entry = self.lookup(game_id)
+                if entry is not None:
+                    return entry
+                entry = self.load(game_id)
+                if entry is None:
+                    return None
+                with self.lock:
+                    self.games[game_id] = entry
+                    self.games.move_to_end(game_id)
+                    while len(self.games) > self.max_games:
+                        self.games.popitem(last=False)
+            return entry
+        finally:
+            with self.lock:
+                game_lock[1] -= 1
+                if game_lock[1] == 0:
+                    del self.game_locks[game_id]
+
+    def lookup(self, game_id: str):
+        """The entry of the game if it can be used as is, otherwise None."""
+        with self.lock:
+            entry = self.games.get(game_id)
+            if entry is None or not (entry.final or time.time() - entry.updated < self.live_ttl):
+                return None
+            self.games.move_to_end(game_id)
+            return entry
+
+    def load(self, game_id: str):
+        # same rules as the GameClient: the cached features are not used while replaying games,
+        # and the feeds of the live games are always refreshed
+        if not fetch_data.FORCE_LIVE:
+            X = self.cache.get(game_id, info=True)
+            if X is not None:
+                return GameFeatures(game_id, X, final=True)
+        df = pd_make_df.create_dataframe_from_game(game_id, use_cache=not fetch_data.live_game(game_id))
+        if df is None:
+            return None
+        X = featurize(df)
+        final = "GAME_END" in df["eventType"].values
+        if final:
+            self.cache.put(game_id, X)
+        return GameFeatures(game_id, select_model_columns(X, ALL_FEATURES_MODEL, info=True), final)
+
+
+class GameFeatures:
+    def __init__(self, game_id: str, X: pd.DataFrame, final: bool):
+        """
+        Features of the shots of a game at some point (see SharedGameFeatures), and the
+        predictions of the models on them, computed once per loaded model.
+        """
+        self.game_id = game_id
+        self.X = X
+        self.final = final
+        self.updated = time.time()
+        self.predictions = {}  # model name -> (model_key, probabilities)
+        self.lock = threading.Lock()
+
+    def predict(self, model_name: str, predict, model_key=None):
+        """
+        Probabilities of the shots for a model, computed with predict(matrix of the model
+        features) the first time only, and again when model_key changes (e.g. another version
+        or backend of the model was loaded under the same name).
+        """
+        with self.lock:
+            cached = self.predictions.get(model_name)
+            if cached is None or cached[0] != model_key:
+                cached = self.predictions[model_name] = (model_key, predict(self.X[get_columns(model_name)]))
+            return cached[1]
+
+
+if __name__ == "__main__":
+    # Featurize the cached games of the seasons used to train the models
+    from ift6758.data.season_index import existing_game_ids
+    cache = FeatureCache()
+    for year in [2015, 2016, 2017, 2018, 2019]:
+        game_ids = existing_game_ids(year, 'R') + existing_game_ids(year, 'P')
+        print(year, len(cache.season_features(year, game_ids=game_ids)), "shots")
@@ -0,0 +1,229 @@
+"""
+On-disk feature matrix of the shots of one or more seasons, read through memory maps, so that
+training and scoring jobs over several seasons only keep in memory the rows they work on.
+
+File layout: the magic string FMAT1, a fixed size JSON header (columns, dtypes, number of rows
+and offset of each block), then three C-ordered blocks of n_rows rows, aligned on 64 bytes:
+    X:      float32, the features of ALL_FEATURES_MODEL, in schema order
+    index:  int64,   columns gameId, eventIdx
+    y:      int8,    isGoal
+
+Export the cached features of some seasons, then score them by batches of rows:
+
+    $ python -m ift6758.data.feature_matrix data/features/2016.fmat 2016
+
+    >>> m = FeatureMatrix("data/features/2016.fmat")
+    >>> for X, y in m.batches(model_name='xgboost-best-select-features'):
+    ...     booster.inplace_predict(X)
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from ift6758.data.feature_cache import ALL_FEATURES_MODEL, FeatureCache
+from ift6758.data.feature_schema import get_columns
+
+
+MAGIC = b"FMAT1"
+# the header and the blocks are padded to a multiple of this size
+ALIGNMENT = 64
+
+INDEX_COLUMNS = ["gameId", "eventIdx"]
+BLOCKS = [
+    # name, dtype
+    ("index", "int64"),
+    ("y", "int8"),
+    ("X", "float32"),
+]
+
+
+def header_size(columns: list):
+    """Size reserved for the header, large enough for any number of rows."""
+    header = make_header(columns, n_rows=np.iinfo(np.int64).max, offsets={name: np.iinfo(np.int64).max for name, _ in BLOCKS})
+    size = len(MAGIC) + 8 + len(header)
+    return (size // ALIGNMENT + 1) * ALIGNMENT
+
+
+def make_header(columns: list, n_rows: int, offsets: dict):
+    return json.dumps({
+        'n_rows': int(n_rows),
+        'blocks': {
+            'index': {'dtype': 'int64', 'columns': INDEX_COLUMNS, 'offset': int(offsets['index'])},
+            'y': {'dtype': 'int8', 'columns': ['isGoal'], 'offset': int(offsets['y'])},
+            'X': {'dtype': 'float32', 'columns': list(columns), 'offset': int(offsets['X'])},
+        },
+    }).encode()
+
+
+def pad(f):
+    """Pads the file being written to the next multiple of ALIGNMENT, returns the new position."""
+    f.write(b"\0" * (-f.tell() % ALIGNMENT))
+    return f.tell()
+
+
+def write_feature_matrix(path, frames, columns=None):
+    """
+    Writes feature matrices (e.g. the ones of FeatureCache.game_features, one game at a time) to a
+    single feature matrix file. The frames are written as they come, so that only one of them is
+    in memory at a time. The file is written atomically.
+    Args:
+        path: path of the file to write
+        frames: iterable of (gameId, dataframe with columns eventIdx, isGoal and the features)
+        columns (list): feature columns to write (features of ALL_FEATURES_MODEL if None)
+    Returns:
+        n_rows (int): number of rows written
+    """
+    columns = get_columns(ALL_FEATURES_MODEL) if columns is None else list(columns)
+    size = header_size(columns)
+    folder = os.path.dirname(os.path.abspath(path))
+    os.makedirs(folder, exist_ok=True)
+
+    n_rows = 0
+    fd, tmp_path = tempfile.mkstemp(dir=folder, suffix=".tmp")
+    try:
+        # X is written in place, index and y in side files appended at the end
+        with os.fdopen(fd, "wb") as f, tempfile.TemporaryFile(dir=folder) as f_index, \
+                tempfile.TemporaryFile(dir=folder) as f_y:
+            f.write(b"\0" * size)
+            for game_id, X in frames:
+                if X is None or len(X) == 0:
+                    continue
+                index = np.empty((len(X), 2), dtype=np.int64)
+                index[:, 0] = int(game_id)
+                index[:, 1] = X["eventIdx"].values
+                f_index.write(index.tobytes())
+                f_y.write(X["isGoal"].values.astype(np.int8).tobytes())
+                f.write(np.ascontiguousarray(X[columns].values, dtype=np.float32).tobytes())
+                n_rows += len(X)
+
+            offsets = {'X': size, 'index': pad(f)}
+            f_index.seek(0)
+            shutil.copyfileobj(f_index, f)
+            offsets['y'] = pad(f)
+            f_y.seek(0)
+            shutil.copyfileobj(f_y, f)
+
+            header = make_header(columns, n_rows, offsets)
+            f.seek(0)
+            f.write(MAGIC + len(header).to_bytes(8, "little") + header)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return n_rows
+
+
+def export_seasons(path, years: list, cache=None, game_ids=None):
+    """
+    Writes the features of the games of some seasons to a feature matrix file, from the feature
+    cache (the missing games are featurized from their feed and cached).
+    Args:
+        path: path of the file to write
+        years (list): first years of the seasons
+        cache (FeatureCache): FeatureCache() if None
+        game_ids (dict): year -> game IDs; by default, the regular season and playoff games of
+            the season index
+    Returns:
+        n_rows (int): number of shots written
+    """
+    cache = FeatureCache() if cache is None else cache
+    if game_ids is None:
+        from ift6758.data.season_index import existing_game_ids
+        game_ids = {year: existing_game_ids(year, 'R') + existing_game_ids(year, 'P') for year in years}
+
+    def frames():
+        for year in years:
+            for game_id in game_ids[year]:
+                yield game_id, cache.game_features(game_id)
+
+    return write_feature_matrix(path, frames())
+
+
+class FeatureMatrix:
+    def __init__(self, path):
+        """
+        Read-only view of a feature matrix file (see write_feature_matrix). The blocks are memory
+        mapped: slicing rows does not copy them, and only the pages that are read are loaded.
+        Args:
+            path: path of the file
+        """
+        self.path = path
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a feature matrix file")
+            length = int.from_bytes(f.read(8), "little")
+            self.header = json.loads(f.read(length))
+        self.n_rows = self.header["n_rows"]
+        self.columns = self.header["blocks"]["X"]["columns"]
+
+        blocks = {}
+        for name, dtype in BLOCKS:
+            block = self.header["blocks"][name]
+            if block["dtype"] != dtype:
+                raise ValueError(f"{path}: unexpected dtype {block['dtype']} for block {name}")
+            shape = (self.n_rows, len(block["columns"])) if name != "y" else (self.n_rows,)
+            blocks[name] = np.memmap(path, dtype=dtype, mode="r", offset=block["offset"], shape=shape) \
+                if self.n_rows else np.empty(shape, dtype=dtype)
+        self.index = blocks["index"]
+        self.y = blocks["y"]
+        self.X = blocks["X"]
+
+    def __len__(self):
+        return self.n_rows
+
+    def column_indices(self, model_name=None):
+        """Positions in X of the features of the model (every column if None)."""
+        if model_name is None:
+            return None
+        positions = {c: i for i, c in enumerate(self.columns)}
+        try:
+            return [positions[c] for c in get_columns(model_name)]
+        except KeyError as e:
+            raise ValueError(f"{self.path} has no column {e} of model {model_name}")
+
+    def rows(self, start=None, stop=None, model_name=None):
+        """
+        Features and labels of the rows [start, stop). Without model_name, X is a view of the file;
+        with it, only the selected rows are copied to reorder the columns.
+        Returns:
+            X: float32 array (rows, features), y: int8 array (rows,)
+        """
+        X = self.X[start:stop]
+        indices = self.column_indices(model_name)
+        if indices is not None and indices != list(range(len(self.columns))):
+            X = X[:, indices]
+        return X, self.y[start:stop]
+
+    def batches(self, batch_size=65536, model_name=None):
+        """Iterates over rows() by batches of batch_size rows."""
+        for start in range(0, self.n_rows, batch_size):
+            yield self.rows(start, start + batch_size, model_name)
+
+    def game_rows(self, game_id):
+        """Slice of the rows of a game (the rows of a game are contiguous)."""
+        game_ids = self.index[:, 0]
+        rows = np.flatnonzero(game_ids == int(game_id))
+        return slice(rows[0], rows[-1] + 1) if len(rows) else slice(0, 0)
+
+    def to_dataframe(self, start=None, stop=None, model_name=None):
+        """Rows [start, stop) as a dataframe with columns gameId, eventIdx, isGoal and the features."""
+        X, y = self.rows(start, stop, model_name)
+        columns = self.columns if model_name is None else get_columns(model_name)
+        df = pd.DataFrame(X, columns=columns)
+        df.insert(0, "isGoal", y)
+        df.insert(0, "eventIdx", self.index[start:stop, 1])
+        df.insert(0, "gameId", self.index[start:stop, 0].astype(str))
+        return df
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the cached shot features of seasons to a feature matrix file.")
+    parser.add_argument("path")
+    parser.add_argument("years", type=int, nargs="+")
+    args = parser.parse_args()
+    print(export_seasons(args.path, args.years), "shots written to", args.path)
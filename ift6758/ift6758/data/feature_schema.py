@@ -0,0 +1,109 @@
+"""
+Feature schemas and model files of the served models, keyed by the model names used in the
+model registry.
+
+A schema is the ordered list of (column, dtype) the model was trained on. It is shared by
+the feature engineering (aug3), the serving client (payload construction) and the serving
+app (validation before inference, /features endpoint).
+"""
+
+# Columns produced by aug3, in the order the models were trained on
+ALL_FEATURES = [
+    ('periodTimeSec', 'float64'),
+    ('period', 'int64'),
+    ('coordinate_x', 'float64'),
+    ('coordinate_y', 'float64'),
+    ('distanceFromGoal', 'float64'),
+    ('shotAngle', 'float64'),
+    ('lastEventCoord_x', 'float64'),
+    ('lastEventCoord_y', 'float64'),
+    ('timeDifference', 'float64'),
+    ('distanceDifference', 'float64'),
+    ('rebound', 'int64'),
+    ('shotAngleDifference', 'float64'),
+    ('speed', 'float64'),
+    # shotType one hot encoding
+    ('Backhand', 'float64'),
+    ('Deflected', 'float64'),
+    ('Slap Shot', 'float64'),
+    ('Snap Shot', 'float64'),
+    ('Tip-In', 'float64'),
+    ('Wrap-around', 'float64'),
+    ('Wrist Shot', 'float64'),
+    # lastEventType one hot encoding
+    ('BLOCKED_SHOT', 'float64'),
+    ('FACEOFF', 'float64'),
+    ('GIVEAWAY', 'float64'),
+    ('GOAL', 'float64'),
+    ('HIT', 'float64'),
+    ('MISSED_SHOT', 'float64'),
+    ('PENALTY', 'float64'),
+    ('SHOT', 'float64'),
+    ('TAKEAWAY', 'float64'),
+]
+
+# The select features model was trained without these columns
+SELECT_FEATURES = [f for f in ALL_FEATURES if f[0] not in ('PENALTY', 'lastEventCoord_x')]
+
+FEATURE_SCHEMAS = {
+    'xgboost-best-select-features': SELECT_FEATURES,
+    'xgboost-best-all-features': ALL_FEATURES,
+    'xgboost-base-all-features': ALL_FEATURES,
+}
+
+# File of each model in the models folder of the serving app (matching_model in serving/app.py)
+MODEL_FILES = {
+    'xgboost-best-select-features': 'XGBoost_best_select_features.pkl',
+    'xgboost-best-all-features': 'XGBoost_best_all_features.pkl',
+    'xgboost-base-all-features': 'XGBoost_base_all_features.pkl'
+}
+
+DEFAULT_MODEL = 'xgboost-best-all-features'
+
+
+def get_columns(model_name: str):
+    """
+    Returns the ordered list of input columns of a model.
+    Args:
+        model_name (str): model name, one of the keys of FEATURE_SCHEMAS
+    Returns:
+        list: column names, in the order expected by the model
+    """
+    if model_name not in FEATURE_SCHEMAS:
+        raise ValueError(f'Unknown model: {model_name}. Valid models are: {list(FEATURE_SCHEMAS)}')
+    return [name for name, _ in FEATURE_SCHEMAS[model_name]]
+
+
+def get_schema(model_name: str):
+    """
+    Returns the schema of a model in a json serializable format.
+    Args:
+        model_name (str): model name, one of the keys of FEATURE_SCHEMAS
+    Returns:
+        dict: {'model': model_name, 'columns': [...], 'dtypes': [...]}
+    """
+    columns = get_columns(model_name)
+    return {
+        'model': model_name,
+        'columns': columns,
+        'dtypes': [dtype for _, dtype in FEATURE_SCHEMAS[model_name]],
+    }
+
+
+def validate_columns(model_name: str, columns: list):
+    """
+    Checks that the given columns are exactly the input columns of a model, in the same order.
+    Raises a ValueError describing the mismatch otherwise.
+    Args:
+        model_name (str): model name, one of the keys of FEATURE_SCHEMAS
+        columns (list): column names of the matrix to score
+    """
+    expected = get_columns(model_name)
+    if list(columns) == expected:
+        return
+    missing = [c for c in expected if c not in columns]
+    unexpected = [c for c in columns if c not in expected]
+    if missing or unexpected:
+        raise ValueError(f'Columns do not match the schema of {model_name}: '
+                         f'missing {missing}, unexpected {unexpected}')
+    raise ValueError(f'Columns are not in the order of the schema of {model_name}: expected {expected}')
@@ -0,0 +1,114 @@
+"""
+Benchmark of the featurization of a full season (synthetic feeds, see synthetic.py): time spent in
+each stage of create_dataframe_from_game, and add_features_set1 against its previous version
+(pd.to_datetime time parsing, shift of the whole frame).
+
+    $ python -m ift6758.data.featurize_bench --games 1271 --events 350
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+import pandas as pd
+
+from ift6758.data import pd_make_df, synthetic
+
+
+def reference_add_features_set1(df):
+    """Previous add_features_set1, kept as the reference of the benchmark."""
+    df[["adjusted_x", "adjusted_y"]] = df[["coordinate_x", "coordinate_y"]].copy()
+    df.loc[df.rinkSide == "right", ["adjusted_x", "adjusted_y"]] *= -1
+
+    df["distanceFromGoal"] = np.sqrt(
+        (df["adjusted_x"] - 89)**2 + (df["adjusted_y"])**2
+    )
+    df["shotAngle"] = np.arcsin(df["adjusted_y"]/df["distanceFromGoal"])
+
+    # Time convert
+    df["periodTimeSec"] = (pd.to_datetime(df["periodTimeSec"], format="%M:%S") - pd.to_datetime("0:0", format="%M:%S")).dt.total_seconds()
+
+    #shifted df for differencing
+    shifted_df = df.shift()
+
+    # Feature Eng 2
+    df["rebound"] = shifted_df["eventType"] == "SHOT"
+    df["lastEventType"] = shifted_df["eventType"]
+    df[['lastEventCoord_x', 'lastEventCoord_y']] = shifted_df[["coordinate_x", "coordinate_y"]]
+
+    df["timeDifference"] = df["periodTimeSec"] - shifted_df["periodTimeSec"]
+
+    df["distanceDifference"] = np.sqrt(
+        (df["coordinate_x"] - shifted_df["coordinate_x"])**2 +
+        (df["coordinate_y"] - shifted_df["coordinate_y"])**2
+    )
+
+    df["shotAngleDifference"] = np.where(
+        df["lastEventType"] == "SHOT",
+        df["shotAngle"] - shifted_df["shotAngle"],
+        0
+    )
+
+    df["speed"] = np.abs(df["distanceDifference"]/df["timeDifference"])
+    df["speed"] = df['speed'].replace([np.inf, -np.inf], -1) # in case of division by 0
+
+    df = df.drop(["adjusted_x", "adjusted_y"], axis="columns")
+
+    return df
+
+
+FEATURES = [
+    "distanceFromGoal", "shotAngle", "periodTimeSec", "rebound", "lastEventCoord_x", "lastEventCoord_y",
+    "timeDifference", "distanceDifference", "shotAngleDifference", "speed",
+]
+
+
+def benchmark(feeds: dict):
+    """
+    Featurizes every game of feeds (game ID -> live feed), stage by stage, and checks that
+    add_features_set1 gives the same features as reference_add_features_set1.
+    Returns:
+        stats: dict with the number of games and events, and the seconds spent in each stage
+    """
+    timings = {'parse_plays': 0.0, 'add_rinkSide': 0.0, 'add_features_set1': 0.0, 'reference_add_features_set1': 0.0}
+    n_events = 0
+    for game_id, data in feeds.items():
+        start = time.perf_counter()
+        df = pd_make_df.parse_plays(data["liveData"]["plays"]["allPlays"])
+        df["gameId"] = game_id
+        timings['parse_plays'] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        df = pd_make_df.add_rinkSide(df, data)
+        timings['add_rinkSide'] += time.perf_counter() - start
+
+        reference = df.copy()
+        start = time.perf_counter()
+        reference = reference_add_features_set1(reference)
+        timings['reference_add_features_set1'] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        df = pd_make_df.add_features_set1(df)
+        timings['add_features_set1'] += time.perf_counter() - start
+
+        pd.testing.assert_frame_equal(df[FEATURES], reference[FEATURES], check_dtype=False)
+        n_events += len(df)
+
+    return dict(
+        games=len(feeds),
+        events=n_events,
+        speedup=timings['reference_add_features_set1'] / timings['add_features_set1'],
+        **timings,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the featurization of a synthetic season.")
+    parser.add_argument("--year", type=int, default=2016)
+    parser.add_argument("--games", type=int, default=1271)
+    parser.add_argument("--events", type=int, default=350)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    feeds = synthetic.generate_season(args.year, n_games=args.games, n_events=args.events, seed=args.seed)
+    print(json.dumps(benchmark(feeds), indent=2))
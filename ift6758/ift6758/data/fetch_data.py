@@ -1,9 +1,76 @@
 import pandas as pd
 
-import requests
 import json
+import logging
 import os
 import re
+import sqlite3
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from ift6758.data import season_index
+from ift6758.data.fetcher import FetchError, GameNotFoundError, JobJournal, game_lock, get_fetcher, validate_feed
+from ift6758.data.game_index import get_game_index, parse_game_info
+
+# Both can be overridden, e.g. to fetch the games from a replay server (see replay.py)
+NHL_API_URL = os.environ.get("NHL_API_URL", "https://statsapi.web.nhl.com/api/v1")
+RAW_DATA_PATH = os.environ.get(
+    "NHL_DATA_DIR", os.path.abspath(os.path.join(os.path.dirname(__file__), "../../../data/raw/"))
+)
+# Treat every game as live, i.e. refresh the cached feeds of the old games too (e.g. replayed games)
+FORCE_LIVE = os.environ.get("NHL_FORCE_LIVE", "0") == "1"
+
+logger = logging.getLogger(__name__)
+
+# Seconds during which the indexed metadata of a game that is not final is used without refetching
+LIVE_MAX_AGE = 10
+
+
+def live_game(game_id):
+    """
+    Whether a game may still be in progress, so that its cached feed is refreshed: the games since
+    2022, or every game if FORCE_LIVE. The feeds of the older games are final.
+    """
+    return FORCE_LIVE or int(str(game_id)[:4]) >= 2022
+
+
+def write_json_atomic(file_path, data):
+    """
+    Writes data as JSON to a temporary file of the same folder, then renames it to file_path, so
+    that readers see either the previous file or the complete new one, never a partial file.
+    """
+    folder = os.path.dirname(os.path.abspath(file_path))
+    os.makedirs(folder, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=folder, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, file_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def read_cached_game(file_path, game_id):
+    """
+    Reads a cached live feed, checking its integrity.
+    Returns:
+        data: the live feed, or None if the file does not exist, is truncated or is not a valid
+            live feed of the game (e.g. error payload cached by an older version)
+    """
+    try:
+        with open(file_path, "r") as f:
+            data = json.load(f)
+        validate_feed(data, game_id)
+    except FileNotFoundError:
+        return None
+    except (ValueError, FetchError) as e:
+        logger.warning("Ignoring invalid cached feed %s: %s", file_path, e)
+        return None
+    return data
 
 
 class FetchData:
@@ -128,7 +195,7 @@ class FetchData:
 
     def get_play_by_play(self, 
                          game_id: str, 
-                         path=os.path.abspath(os.path.join(os.path.dirname(__file__),"../../../data/raw/")), 
+                         path=None, 
                          return_data=True, 
                          use_cache=True):
 
@@ -139,100 +206,183 @@ class FetchData:
         Args:
             game_id (str): Game ID for play-by-play data according to the format documented
                 in https://gitlab.com/dword4/nhlapi/-/blob/master/stats-api.md#game-ids
-            path: Path to which the file is saved
+            path: Path to which the file is saved (RAW_DATA_PATH if None)
             use_cache: whether we check for existence of file.
         Returns: raw data for the specific game in the form of a json object
+            (if the game does not exist, a stub error payload built here, {"messageNumber": 2,
+            "message": ...}, which is not cached)
+        Raises:
+            FetchError: the game could not be downloaded, and is not cached
         """
-        
-        # Check if data has already been fetched in
-        if not os.path.exists("{}/{}.json".format(path, game_id)):
-            # If file doesn't exist, download data using requests package
-            # Store at path/<game_id> in json format
-            response = requests.get("https://statsapi.web.nhl.com/api/v1/game/{}/feed/live/".format(game_id))
-            json_response = response.json()
-
-            with open('{}/{}.json'.format(path, game_id), "w") as f:
-                json_str = json.dumps(json_response)
-                f.write(json_str)
-        else:
-            # file exists. but we don't want to use cached.
-            if not use_cache:
-                response = requests.get("https://statsapi.web.nhl.com/api/v1/game/{}/feed/live/".format(game_id))
-                json_response = response.json()
-
-                with open('{}/{}.json'.format(path, game_id), "w") as f:
-                    json_str = json.dumps(json_response)
-                    f.write(json_str)
-                    
+        if path is None:
+            path = RAW_DATA_PATH
+        file_path = "{}/{}.json".format(path, game_id)
+
+        # Check if data has already been fetched in, and if we want to use it
+        if use_cache:
+            data = read_cached_game(file_path, game_id)
+            if data is not None:
+                return data if return_data else None
+
+        # One download of the game at a time (threads and processes sharing the folder): the
+        # callers that waited for it use its result instead of downloading the game again
+        requested = time.time()
+        os.makedirs(path, exist_ok=True)
+        with game_lock(file_path):
+            data = read_cached_game(file_path, game_id)
+            if data is None or (not use_cache and os.path.getmtime(file_path) < requested):
+                try:
+                    fetched = self.fetch_game(game_id)
+                except FetchError as e:
+                    if data is None:
+                        raise
+                    # e.g. API down during a live game: the last fetched feed is better than nothing
+                    logger.warning("Could not refresh game %s, using the cached feed: %s", game_id, e)
+                else:
+                    if fetched is None:
+                        # game not found (404): stub payload, not cached, so that the game is
+                        # requested again next time
+                        return {"messageNumber": 2, "message": "Game data couldn't be found"} if return_data else None
+                    write_json_atomic(file_path, fetched)
+                    self.index_game(fetched)
+                    data = fetched
+
         if return_data:
-            with open("{}/{}.json".format(path, game_id), 'r') as f:
-                data = json.load(f)
             return data
-    
-    def download_everything(self, years: list, path=os.path.abspath(os.path.join(os.path.dirname(__file__),"../../data/raw/")), return_data=True):
-        """_summary_
 
+    def fetch_game(self, game_id: str):
+        """
+        Downloads the live feed of a game, through the rate limited and retried fetcher
+        (see fetcher.py), and checks it before it is cached.
+        Returns:
+            data: the live feed, or None if the game does not exist (404)
+        Raises:
+            FetchError: the API could not be reached, or did not send a valid live feed
+        """
+        status, data = get_fetcher().get_json("{}/game/{}/feed/live/".format(NHL_API_URL, game_id))
+        if status == 404:
+            return None
+        if status != 200:
+            raise FetchError("game {}: HTTP {}".format(game_id, status))
+        validate_feed(data, game_id)
+        return data
+    
+    def download_everything(self, years: list, path=None, use_index=True, workers=4,
+                            journal_path=None, retry_failed=True):
+        """
+        Downloads the play-by-play data of the regular season and playoff games of each season.
+        The games are fetched by several threads, within the rate limit of the fetcher. A game that
+        fails does not stop the download: it is recorded as failed in the job journal. The games
+        that are recorded as done (or missing) are skipped, so that running the download again
+        resumes it.
         Args:
-            years (list): _description_
+            years (list): first years of the seasons to download
+            path: Path to which the files are saved (RAW_DATA_PATH if None)
+            use_index: only request the games listed in the season index (built if missing, see
+                season_index), instead of every candidate ID of game_ids_regular/game_ids_playoff
+            workers (int): number of games fetched in parallel
+            journal_path: path of the job journal (path/journal.jsonl if None)
+            retry_failed (bool): also request the games that failed in a previous run
+        Returns:
+            summary: dict of status ('done', 'missing', 'failed', 'skipped') -> number of games
         """
+        if path is None:
+            path = RAW_DATA_PATH
+        journal = JobJournal(os.path.join(path, "journal.jsonl") if journal_path is None else journal_path)
+
+        game_ids = []
         for year in years:
-        
-            regular_season_games = self.game_ids_regular(year)
-            playoffs_games = self.game_ids_playoff(year)
-
-            for game_id in regular_season_games:
-                self.get_play_by_play(game_id, path, return_data)
-            for game_id in playoffs_games:
-                self.get_play_by_play(game_id, path, return_data)
-    
-        print('Download finished!')
+
+            if use_index:
+                regular_season_games = season_index.existing_game_ids(year, 'R')
+                playoffs_games = season_index.existing_game_ids(year, 'P')
+            else:
+                regular_season_games = self.game_ids_regular(year)
+                playoffs_games = self.game_ids_playoff(year)
+
+            game_ids += regular_season_games + playoffs_games
+
+        def download(game_id):
+            if journal.done(game_id) or (not retry_failed and journal.status.get(game_id) == "failed"):
+                return
+            try:
+                data = self.get_play_by_play(game_id, path)
+            except Exception as e:
+                logger.warning("Game %s failed: %s", game_id, e)
+                journal.record(game_id, "failed", e)
+            else:
+                journal.record(game_id, "done" if "liveData" in data else "missing")
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(download, game_ids))
+
+        summary = {}
+        for game_id in game_ids:
+            status = journal.status.get(game_id, "skipped")
+            summary[status] = summary.get(status, 0) + 1
+        print('Download finished!', summary)
+        return summary
     
 
-    def get_scores(self, game_id: str):
+    def index_game(self, data: dict):
         """
-        Get number of real goals from live feed dict (raw data)
+        Updates the game index (see game_index) with a freshly fetched live feed.
+        Error payloads (e.g. unknown game ID) are not indexed. Neither is the game if the index
+        cannot be written (e.g. database locked or read only): the feed is cached anyway, and
+        GameIndex.build_from_cache indexes it later.
         """
-        game_year = int(str(game_id)[:4])
-        use_cache = True if game_year < 2022 else False
-
-        data = self.get_play_by_play(game_id, use_cache=use_cache)
-        goal_a = None # away team
-        goal_h = None # home team
-        
-        if data["liveData"].get("linescore") is not None:
-            goal_a = data["liveData"]["linescore"]["teams"]["away"]["goals"]
-            goal_h = data["liveData"]["linescore"]["teams"]["home"]["goals"]
-        
-        # Bug while trying to get number of goals from linescore
-        if goal_a is None and goal_h is None: 
-            goal_a = data["liveData"]["plays"]["currentPlay"]["about"]["goals"]["away"]
-            goal_h = data["liveData"]["plays"]["currentPlay"]["about"]["goals"]["home"]
+        try:
+            return get_game_index().update(data)
+        except (KeyError, TypeError):
+            return None
+        except sqlite3.Error as e:
+            logger.warning("Could not index game %s: %r", data.get("gamePk"), e)
+            return None
 
-        # Get away and home teams tricode
-        away = data["gameData"]["teams"]["away"]["triCode"]
-        home = data["gameData"]["teams"]["home"]["triCode"]
+    def get_game_info(self, game_id: str, max_age=LIVE_MAX_AGE):
+        """
+        Get the game level metadata (teams, score, period, status) from the game index.
+        The live feed is only loaded if the game is not indexed yet, or if it is not final and
+        its metadata is older than max_age seconds. If the index cannot be read or written (e.g.
+        database locked), the metadata is read from the live feed.
+        Raises:
+            GameNotFoundError: the API has no live feed for the game
+        """
+        try:
+            info = get_game_index().get(game_id)
+        except sqlite3.Error as e:
+            logger.warning("Could not read game %s from the index: %r", game_id, e)
+            info = None
+        if info is None or (info["status"] != "Final" and time.time() - info["updated"] > max_age):
+            data = self.get_play_by_play(game_id, use_cache=not live_game(game_id))
+            info = self.index_game(data)
+            if info is None:
+                if "gameData" not in data:
+                    # stub payload of a game not found (see get_play_by_play)
+                    raise GameNotFoundError("Game {} not found: {}".format(game_id, data.get("message")))
+                info = parse_game_info(data)
+        return info
 
-        # Get away and home teams full name
-        away_full = data["gameData"]["teams"]["away"]["name"]
-        home_full = data["gameData"]["teams"]["home"]["name"]
+    def get_scores(self, game_id: str):
+        """
+        Get number of real goals from the game index (see get_game_info)
+        """
+        info = self.get_game_info(game_id)
 
-        real_goals = [goal_a, goal_h]
-        teams = [away, home]
-        teams_full = [away_full, home_full]  
+        real_goals = [info["away_goals"], info["home_goals"]]
+        teams = [info["away"], info["home"]]
+        teams_full = [info["away_name"], info["home_name"]]
 
         return real_goals, teams, teams_full
 
 
     def get_period_info(self, game_id: str):
-        game_year = int(str(game_id)[:4])
-        use_cache = True if game_year < 2022 else False
-        data = self.get_play_by_play(game_id, use_cache=use_cache)
-
-        # Get Period and PeriodTimeRemaining
-        period = data["liveData"]["plays"]["currentPlay"]["about"]["period"]
-        periodTimeRemaining = data["liveData"]["plays"]["currentPlay"]["about"]["periodTimeRemaining"] 
+        """
+        Get period and periodTimeRemaining of the last event from the game index (see get_game_info)
+        """
+        info = self.get_game_info(game_id)
 
-        return period, periodTimeRemaining
+        return info["period"], info["period_time_remaining"]
 
 
 
@@ -0,0 +1,304 @@
+"""
+HTTP layer of the NHL API requests: rate limiting (token bucket), timeouts, retries with
+exponential backoff and jitter, and a circuit breaker that stops hammering the API while it fails.
+Also validates the live feeds before they are cached, locks the games being downloaded, and keeps
+the journal of the bulk downloads so that an interrupted backfill resumes where it stopped.
+"""
+import json
+import os
+import random
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+
+import requests
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: the game locks are only shared by the threads of the process
+    fcntl = None
+
+
+# Defaults of the fetcher shared by the process, can be overridden by environment variables
+RATE = float(os.environ.get("NHL_API_RATE", 10))     # requests per second
+BURST = int(os.environ.get("NHL_API_BURST", 20))
+TIMEOUT = (5, 30)                                     # seconds to connect, to read
+
+# Status codes worth retrying (rate limited, server errors)
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class FetchError(Exception):
+    """A request failed, after the retries."""
+
+
+class CircuitOpenError(FetchError):
+    """The request was not sent: the API failed too many times in a row recently."""
+
+
+class InvalidPayloadError(FetchError):
+    """The API answered, but not with the expected payload."""
+
+
+class GameNotFoundError(FetchError):
+    """The API has no live feed for the game ID (HTTP 404)."""
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        """
+        Token bucket rate limiter, shared by threads: allows burst requests at once, then rate
+        requests per second on average.
+        Args:
+            rate (float): tokens added per second
+            burst (int): capacity of the bucket
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Takes a token, waiting until one is available."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class CircuitBreaker:
+    def __init__(self, max_failures=5, reset_timeout=30.0):
+        """
+        Circuit breaker: after max_failures failed requests in a row, the circuit opens and the
+        requests fail right away during reset_timeout seconds. Then one request is let through
+        (half open): the circuit closes if it succeeds, and opens again otherwise.
+        """
+        self.max_failures = max_failures
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened is None:
+            return "closed"
+        return "open" if time.monotonic() - self.opened < self.reset_timeout else "half-open"
+
+    def before_request(self):
+        """Raises CircuitOpenError if the request must not be sent."""
+        with self.lock:
+            state = self.state
+            if state == "closed":
+                return
+            if state == "half-open" and not self.trial:
+                self.trial = True
+                return
+            raise CircuitOpenError("NHL API unavailable, retry in {:.0f}s".format(
+                max(self.reset_timeout - (time.monotonic() - self.opened), 0)))
+
+    def record(self, success: bool):
+        with self.lock:
+            self.trial = False
+            if success:
+                self.failures = 0
+                self.opened = None
+            else:
+                self.failures += 1
+                if self.failures >= self.max_failures or self.opened is not None:
+                    self.opened = time.monotonic()
+
+
+class Fetcher:
+    def __init__(self, rate=RATE, burst=BURST, timeout=TIMEOUT, retries=4, backoff=0.5, max_backoff=30.0,
+                 breaker=None, session=None):
+        """
+        Sends GET requests to the NHL API, at most rate requests per second, retrying the
+        request errors (connection errors, timeouts, ...), 429 and 5xx with exponential backoff and full jitter.
+        Args:
+            rate (float), burst (int): token bucket of the requests (see TokenBucket)
+            timeout: requests timeout, in seconds (or (connect, read))
+            retries (int): number of retries after the first attempt
+            backoff (float): base delay of the retries, doubled at each retry
+            max_backoff (float): maximum delay between two attempts
+            breaker (CircuitBreaker): CircuitBreaker() if None
+            session (requests.Session): a new session (connection pool) if None
+        """
+        self.bucket = TokenBucket(rate, burst)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker = CircuitBreaker() if breaker is None else breaker
+        self.session = requests.Session() if session is None else session
+
+    def delay(self, attempt: int, response=None):
+        """Seconds to wait before the retry: Retry-After if the API gave one, otherwise full jitter."""
+        if response is not None and response.headers.get("Retry-After", "").isdigit():
+            return min(float(response.headers["Retry-After"]), self.max_backoff)
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def get(self, url: str, params=None):
+        """
+        Sends a GET request.
+        Returns:
+            response: the response, with a status that is not retried (e.g. 200 or 404)
+        Raises:
+            CircuitOpenError: the circuit breaker is open
+            FetchError: every attempt failed
+        """
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.delay(attempt - 1, response))
+            self.breaker.before_request()
+            self.bucket.acquire()
+            response = None
+            try:
+                response = self.session.get(url, params=params, timeout=self.timeout)
+            except requests.RequestException as e:
+                # connection errors, timeouts, but also e.g. a truncated body (ChunkedEncodingError):
+                # every failure is recorded, otherwise a failed half-open trial would keep the
+                # circuit open forever
+                error = e
+            else:
+                if response.status_code not in RETRY_STATUS:
+                    self.breaker.record(True)
+                    return response
+                error = "HTTP {}".format(response.status_code)
+            self.breaker.record(False)
+        raise FetchError("GET {} failed after {} attempts: {}".format(url, self.retries + 1, error))
+
+    def get_json(self, url: str, params=None):
+        """
+        Same as get, and decodes the JSON body of a successful (2xx) response.
+        Returns:
+            status (int), data: the status code and the decoded body, None for another status
+                (e.g. 404, whose body may be an HTML page, or empty)
+        Raises:
+            InvalidPayloadError: the body of a successful response is not JSON
+        """
+        response = self.get(url, params)
+        if not 200 <= response.status_code < 300:
+            return response.status_code, None
+        try:
+            return response.status_code, response.json()
+        except ValueError:
+            raise InvalidPayloadError("GET {}: HTTP {} with a body that is not JSON".format(url, response.status_code))
+
+
+fetchers = {}
+
+def get_fetcher():
+    """Returns the Fetcher shared by the whole process (one rate limit and circuit for the API)."""
+    if "default" not in fetchers:
+        fetchers["default"] = Fetcher()
+    return fetchers["default"]
+
+
+# Lock files shared by the cached files of a folder, in its .locks folder: a bounded set of files
+# instead of one per game ever downloaded, at the cost of rare waits between two games of a stripe
+LOCK_STRIPES = 64
+
+# In-process lock of each file being downloaded, with its number of users: evicted when unused
+game_locks = {}
+game_locks_lock = threading.Lock()
+
+@contextmanager
+def game_lock(file_path):
+    """
+    Exclusive lock on a cached file, held while it is downloaded: by the threads of the process,
+    and by the other processes through one of the LOCK_STRIPES lock files of its folder where fcntl
+    is available.
+    """
+    with game_locks_lock:
+        entry = game_locks.setdefault(file_path, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            if fcntl is None:
+                yield
+                return
+            lock_dir = os.path.join(os.path.dirname(file_path), ".locks")
+            os.makedirs(lock_dir, exist_ok=True)
+            # crc32, unlike hash(), gives the same stripe in every process
+            stripe = zlib.crc32(os.path.basename(file_path).encode()) % LOCK_STRIPES
+            with open(os.path.join(lock_dir, "{}.lock".format(stripe)), "a") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+    finally:
+        with game_locks_lock:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del game_locks[file_path]
+
+
+def validate_feed(data, game_id=None):
+    """
+    Checks that a payload is the live feed of the game, before it is cached.
+    Raises:
+        InvalidPayloadError: error payload, truncated feed, or feed of another game
+    """
+    if not isinstance(data, dict):
+        raise InvalidPayloadError("live feed is not a JSON object")
+    try:
+        pk = data["gameData"]["game"]["pk"]
+        plays = data["liveData"]["plays"]["allPlays"]
+    except (KeyError, TypeError):
+        raise InvalidPayloadError("not a live feed: {}".format(data.get("message", "missing gameData/liveData")))
+    if not isinstance(plays, list):
+        raise InvalidPayloadError("allPlays is not a list")
+    if game_id is not None and str(pk) != str(game_id):
+        raise InvalidPayloadError("live feed of game {} instead of {}".format(pk, game_id))
+
+
+class JobJournal:
+    def __init__(self, path):
+        """
+        Append-only journal (one JSON line per job) of a bulk job: the jobs that succeeded are
+        skipped when the job is run again, e.g. after an interruption.
+        Args:
+            path: path of the journal file, created if it does not exist
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.status = {}
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # last line cut by an interruption
+                        continue
+                    self.status[entry["job"]] = entry["status"]
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def done(self, job: str):
+        return self.status.get(str(job)) in ("done", "missing")
+
+    def record(self, job: str, status: str, error=None):
+        """
+        Records the outcome of a job: 'done', 'missing' (nothing to fetch) or 'failed'.
+        """
+        entry = {'job': str(job), 'status': status, 'time': time.time()}
+        if error is not None:
+            entry['error'] = str(error)
+        with self.lock:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+            self.status[str(job)] = status
@@ -0,0 +1,176 @@
+import glob
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+INDEX_DB = os.environ.get(
+    "NHL_GAME_INDEX", os.path.abspath(os.path.join(os.path.dirname(__file__), "../../../data/games.sqlite"))
+)
+
+COLUMNS = [
+    'game_id', 'season', 'game_type', 'date',
+    'away', 'home', 'away_name', 'home_name',
+    'away_goals', 'home_goals',
+    'period', 'period_time_remaining',
+    'status', 'detailed_status', 'updated',
+]
+
+
+def parse_game_info(data: dict):
+    """
+    Extracts the game level metadata from a live feed dict (raw data).
+    Args:
+        data (dict): live feed of a game, as returned by FetchData.get_play_by_play
+    Returns:
+        info: dict with the keys of COLUMNS
+    """
+    game_data = data["gameData"]
+    live_data = data["liveData"]
+    current_play = live_data["plays"].get("currentPlay", {}).get("about", {})
+
+    goal_a = None # away team
+    goal_h = None # home team
+    if live_data.get("linescore") is not None:
+        goal_a = live_data["linescore"]["teams"]["away"].get("goals")
+        goal_h = live_data["linescore"]["teams"]["home"].get("goals")
+
+    # Bug while trying to get number of goals from linescore
+    if goal_a is None and goal_h is None:
+        goal_a = current_play.get("goals", {}).get("away")
+        goal_h = current_play.get("goals", {}).get("home")
+
+    return {
+        'game_id': str(game_data["game"]["pk"]),
+        'season': str(game_data["game"]["season"]),
+        'game_type': game_data["game"]["type"],
+        'date': game_data.get("datetime", {}).get("dateTime"),
+        'away': game_data["teams"]["away"]["triCode"],
+        'home': game_data["teams"]["home"]["triCode"],
+        'away_name': game_data["teams"]["away"]["name"],
+        'home_name': game_data["teams"]["home"]["name"],
+        'away_goals': goal_a,
+        'home_goals': goal_h,
+        'period': current_play.get("period"),
+        'period_time_remaining': current_play.get("periodTimeRemaining"),
+        'status': game_data.get("status", {}).get("abstractGameState"),
+        'detailed_status': game_data.get("status", {}).get("detailedState"),
+        'updated': time.time(),
+    }
+
+
+class GameIndex:
+    def __init__(self, path=None):
+        """
+        SQLite index of the game level metadata (teams, score, period, status) of the fetched
+        games, so that they can be queried without loading the full play-by-play feeds.
+        Args:
+            path: path of the SQLite database file (INDEX_DB if None), created if it does not exist
+        """
+        self.path = INDEX_DB if path is None else path
+        # sqlite connections cannot be shared between threads
+        self.local = threading.local()
+        self.create_table()
+
+    @property
+    def connection(self):
+        if getattr(self.local, "connection", None) is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.row_factory = sqlite3.Row
+            # readers do not block the writer (and the other way around)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self.local.connection = connection
+        return self.local.connection
+
+    def create_table(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self.connection as c:
+            c.execute("""
+                CREATE TABLE IF NOT EXISTS games (
+                    game_id TEXT PRIMARY KEY,
+                    season TEXT, game_type TEXT, date TEXT,
+                    away TEXT, home TEXT, away_name TEXT, home_name TEXT,
+                    away_goals INTEGER, home_goals INTEGER,
+                    period INTEGER, period_time_remaining TEXT,
+                    status TEXT, detailed_status TEXT, updated REAL
+                )
+            """)
+            c.execute("CREATE INDEX IF NOT EXISTS games_season_away ON games (season, away)")
+            c.execute("CREATE INDEX IF NOT EXISTS games_season_home ON games (season, home)")
+
+    def update(self, data: dict):
+        """
+        Inserts or updates the metadata of a game from its live feed.
+        Args:
+            data (dict): live feed of a game
+        Returns:
+            info: the indexed metadata (see parse_game_info)
+        """
+        info = parse_game_info(data)
+        with self.connection as c:
+            c.execute(
+                "INSERT OR REPLACE INTO games ({}) VALUES ({})".format(
+                    ", ".join(COLUMNS), ", ".join("?" * len(COLUMNS))),
+                [info[col] for col in COLUMNS]
+            )
+        return info
+
+    def get(self, game_id: str):
+        """
+        Returns the metadata of a game as a dict, or None if the game is not indexed.
+        """
+        row = self.connection.execute("SELECT * FROM games WHERE game_id = ?", (str(game_id),)).fetchone()
+        return None if row is None else dict(row)
+
+    def games_for_team(self, team: str, season):
+        """
+        Lists the indexed games of a team during a season, ordered by date.
+        Args:
+            team (str): team tricode, e.g. 'MTL'
+            season: season as in the feeds ('20162017'), or its first year (2016)
+        Returns:
+            games: list of dicts (see parse_game_info)
+        """
+        season = str(season)
+        if len(season) == 4:
+            season = season + str(int(season) + 1)
+        rows = self.connection.execute(
+            "SELECT * FROM games WHERE season = ? AND away = ? "
+            "UNION ALL SELECT * FROM games WHERE season = ? AND home = ? ORDER BY date",
+            (season, team, season, team)
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    def build_from_cache(self, path):
+        """
+        Indexes every game of the raw data cache (e.g. to create the index from existing data).
+        Args:
+            path: folder of the <game_id>.json files
+        Returns:
+            n: number of indexed games
+        """
+        n = 0
+        for file in glob.glob(os.path.join(path, "*.json")):
+            try:
+                with open(file, "r") as f:
+                    self.update(json.load(f))
+                n += 1
+            except (ValueError, KeyError, TypeError):
+                # not a valid live feed (e.g. error payload)
+                continue
+        return n
+
+
+indexes = {}
+
+def get_game_index(path=None):
+    """
+    Returns the GameIndex of the given database (INDEX_DB if None), shared by the whole process.
+    """
+    if path is None:
+        path = INDEX_DB
+    if path not in indexes:
+        indexes[path] = GameIndex(path)
+    return indexes[path]
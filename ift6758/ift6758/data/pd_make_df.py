@@ -6,6 +6,7 @@ import os
 from sklearn.preprocessing import OneHotEncoder
 
 from ift6758.data.fetch_data import FetchData
+from ift6758.data.feature_schema import get_columns
 pd.options.mode.chained_assignment = None
 
 class RinkMapping:
@@ -36,7 +37,9 @@ def add_rinkSide(df, data):
         rinkside_df.columns = ["period", "home", "away"]
         rinkside_df = rinkside_df.melt("period", value_name="rinkSide", var_name="teamType")
 
-        df = pd.concat([df.set_index(["period", "teamType"]), rinkside_df.set_index(["period", "teamType"])], axis=1).reset_index()
+        # left merge: one row per event, in the order of the feed (an outer concat adds event-less
+        # rows for the periods/teams without events yet, e.g. at the start of a period in live games)
+        df = df.merge(rinkside_df, on=["period", "teamType"], how="left")
     except:
         infer_rinkSide = True
         df["rinkSide"] = None
@@ -68,127 +71,208 @@ def add_rinkSide(df, data):
         merge_rightRink = merge_rightRink[["rinkSide_app"]]
         merge_rightRink = merge_rightRink.reset_index()
 
-        rinkmap = RinkMapping(merge_rightRink.query("period == 1")["teamType"].values)
+        right = merge_rightRink.query("period == 1")["teamType"].values
+        if len(right) == 0:
+            # no coordinates in period 1 yet (start of a live game): nothing to infer from
+            return df
+        rinkmap = RinkMapping(right[0])
 
         df["rinkSide"] = df[["period", "teamType"]].apply(lambda x: rinkmap.pred(*x), axis=1)
 
     return df
 
 
+def parse_period_time(times):
+    """
+    Converts "MM:SS" period times to seconds, with integer arithmetic on the bytes of the strings
+    (pd.to_datetime parses every string as a date). Missing times give NaN, and the times that are
+    not exactly "MM:SS" (e.g. "5:03") are split on ":".
+    Args:
+        times: array-like of str or None
+    Returns:
+        seconds: float64 array
+    """
+    times = np.asarray(times, dtype=object)
+    seconds = np.full(len(times), np.nan)
+    present = pd.notna(times)
+    if not present.any():
+        return seconds
+    # 5 bytes per time, shorter strings are padded with null bytes
+    digits = np.asarray(times[present].astype("S5")).view(np.uint8).reshape(-1, 5).astype(np.int64) - ord("0")
+    mmss = (digits[:, 2] == ord(":") - ord("0")) & (digits[:, [0, 1, 3, 4]] >= 0).all(axis=1) \
+        & (digits[:, [0, 1, 3, 4]] <= 9).all(axis=1)
+    values = (digits[:, 0] * 10 + digits[:, 1]) * 60 + digits[:, 3] * 10 + digits[:, 4]
+    values = values.astype(np.float64)
+    if not mmss.all():
+        values[~mmss] = [
+            int(m) * 60 + int(sec) for m, sec in (t.split(":") for t in times[present][~mmss])
+        ]
+    seconds[present] = values
+    return seconds
+
+
+def lag(values: np.ndarray):
+    """values shifted by one row (the previous event), NaN for the first one."""
+    shifted = np.empty(len(values), dtype=np.float64 if values.dtype.kind in "biuf" else object)
+    shifted[1:] = values[:-1]
+    shifted[:1] = np.nan if shifted.dtype == np.float64 else None
+    return shifted
+
+
 def add_features_set1(df):
-    df[["adjusted_x", "adjusted_y"]] = df[["coordinate_x", "coordinate_y"]].copy()
-    df.loc[df.rinkSide == "right", ["adjusted_x", "adjusted_y"]] *= -1
-    
-    df["distanceFromGoal"] = np.sqrt(
-        (df["adjusted_x"] - 89)**2 + (df["adjusted_y"])**2
-    )
-    df["shotAngle"] = np.arcsin(df["adjusted_y"]/df["distanceFromGoal"])
+    x = df["coordinate_x"].to_numpy(dtype=np.float64)
+    y = df["coordinate_y"].to_numpy(dtype=np.float64)
+    # coordinates of the shooting team's side
+    sign = np.where(df["rinkSide"].to_numpy() == "right", -1.0, 1.0)
+    adjusted_x, adjusted_y = x * sign, y * sign
+
+    distance = np.sqrt((adjusted_x - 89)**2 + adjusted_y**2)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        angle = np.arcsin(adjusted_y / distance)
+    df["distanceFromGoal"] = distance
+    df["shotAngle"] = angle
     
     # Time convert
-    df["periodTimeSec"] = (pd.to_datetime(df["periodTimeSec"], format="%M:%S") - pd.to_datetime("0:0", format="%M:%S")).dt.total_seconds()
+    time = parse_period_time(df["periodTimeSec"].to_numpy())
+    df["periodTimeSec"] = time
     
-    #shifted df for differencing
-    shifted_df = df.shift()
+    # previous event, only for the columns that are used
+    event_type = df["eventType"].to_numpy()
+    last_event_type = lag(event_type)
+    last_x, last_y = lag(x), lag(y)
     
     # Feature Eng 2
-    df["rebound"] = shifted_df["eventType"] == "SHOT"
-    df["lastEventType"] = shifted_df["eventType"]
-    df[['lastEventCoord_x', 'lastEventCoord_y']] = shifted_df[["coordinate_x", "coordinate_y"]]
+    df["rebound"] = last_event_type == "SHOT"
+    df["lastEventType"] = last_event_type
+    df["lastEventCoord_x"] = last_x
+    df["lastEventCoord_y"] = last_y
 
-    df["timeDifference"] = df["periodTimeSec"] - shifted_df["periodTimeSec"]
+    df["timeDifference"] = time - lag(time)
 
-    df["distanceDifference"] = np.sqrt(
-        (df["coordinate_x"] - shifted_df["coordinate_x"])**2 + 
-        (df["coordinate_y"] - shifted_df["coordinate_y"])**2
-    )
+    df["distanceDifference"] = np.sqrt((x - last_x)**2 + (y - last_y)**2)
 
     df["shotAngleDifference"] = np.where(
-        df["lastEventType"] == "SHOT", 
-        df["shotAngle"] - shifted_df["shotAngle"], 
+        last_event_type == "SHOT", 
+        angle - lag(angle), 
         0
     )
 
-    df["speed"] = np.abs(df["distanceDifference"]/df["timeDifference"])
-    df["speed"] = df['speed'].replace([np.inf, -np.inf], -1) # in case of division by 0
-    
-    df = df.drop(["adjusted_x", "adjusted_y"], axis="columns")
+    with np.errstate(invalid="ignore", divide="ignore"):
+        speed = np.abs(df["distanceDifference"].to_numpy() / df["timeDifference"].to_numpy())
+    speed[np.isinf(speed)] = -1 # in case of division by 0
+    df["speed"] = speed
     
     return df
 
 
 def parse_players(players_list):
-    shooter = None
-    goalie  = None
-    
+    """
+    Shooter (or scorer) and goalie of an event, from its players list.
+    Returns:
+        (shooterId, shooter, goalieId, goalie), None for the ones that are not involved
+    """
+    shooter_id, shooter = None, None
+    goalie_id, goalie = None, None
     
+    if not players_list: return shooter_id, shooter, goalie_id, goalie
     for player in players_list:
-        if player["playerType"] in ("Shooter", "Scorer"):
-            shooter = player["player"]["fullName"]
-        if player["playerType"] == "Goalie":
-            goalie = player["player"]["fullName"]
-    if shooter is None and goalie is None: return None
-    return f"{shooter} | {goalie}"
+        player_type = player["playerType"]
+        if player_type == "Shooter" or player_type == "Scorer":
+            shooter_id, shooter = player["player"]["id"], player["player"]["fullName"]
+        elif player_type == "Goalie":
+            goalie_id, goalie = player["player"]["id"], player["player"]["fullName"]
+    return shooter_id, shooter, goalie_id, goalie
 
 def add_players(df):
-    df = df.dropna(subset="players")
-    df["parsed_players"] = df["players"].map(parse_players)
-    df[["shooter", "goalie"]] = df["parsed_players"].str.split("|", expand=True)
-    df = df.drop(["parsed_players", "players"], axis=1)
-    return df
+    """
+    Adds the shooterId, shooter, goalieId and goalie columns from a players column of play
+    dicts (parse_plays already returns them).
+    """
+    players = pd.DataFrame(
+        [parse_players(players_list) for players_list in df["players"].values],
+        columns=["shooterId", "shooter", "goalieId", "goalie"], index=df.index
+    )
+    return df.assign(**players_dtypes(players))
+
+def players_dtypes(players):
+    """IDs as nullable integers, names as categoricals (a few hundred players for thousands of events)."""
+    return {
+        "shooterId": pd.array(players["shooterId"], dtype="Int64"),
+        "shooter": pd.Categorical(players["shooter"]),
+        "goalieId": pd.array(players["goalieId"], dtype="Int64"),
+        "goalie": pd.Categorical(players["goalie"]),
+    }
+
+
+def parse_plays(plays: list):
+    """
+    Builds the event table of a game from its plays (liveData.plays.allPlays), in a single pass
+    over the play dicts: only the used fields are read (pd.json_normalize flattens every field of
+    every play), and the shooter and goalie are extracted on the way.
+    Returns:
+        df: dataframe with one row per play
+    """
+    eventType, eventIdx, period, periodType, periodTime, periodTimeRem = [], [], [], [], [], []
+    coordinate_x, coordinate_y, teamTriCode, shotType, emptyNet = [], [], [], [], []
+    shooterId, shooter, goalieId, goalie = [], [], [], []
+
+    for play in plays:
+        result = play["result"]
+        about = play["about"]
+        coordinates = play.get("coordinates") or {}
+        team = play.get("team")
+
+        eventType.append(result["eventTypeId"])
+        shotType.append(result.get("secondaryType"))
+        emptyNet.append(result.get("emptyNet"))
+        eventIdx.append(about["eventIdx"])
+        period.append(about["period"])
+        periodType.append(about.get("periodType"))
+        periodTime.append(about.get("periodTime"))
+        periodTimeRem.append(about.get("periodTimeRemaining"))
+        coordinate_x.append(coordinates.get("x"))
+        coordinate_y.append(coordinates.get("y"))
+        teamTriCode.append(team.get("triCode") if team else None)
+
+        players = parse_players(play.get("players"))
+        shooterId.append(players[0])
+        shooter.append(players[1])
+        goalieId.append(players[2])
+        goalie.append(players[3])
+
+    df = pd.DataFrame({
+        "eventType": eventType,
+        "eventIdx": np.array(eventIdx, dtype=np.int64),
+        "period": np.array(period, dtype=np.int64),
+        "periodType": periodType,
+        "periodTimeSec": periodTime,
+        "periodTimeRem": periodTimeRem,
+        # None -> NaN, also when no play has coordinates yet
+        "coordinate_x": np.array(coordinate_x, dtype=np.float64),
+        "coordinate_y": np.array(coordinate_y, dtype=np.float64),
+        "shotType": shotType,
+        "teamTriCode": teamTriCode,
+        "emptyNet": emptyNet,
+    })
+    players = pd.DataFrame({"shooterId": shooterId, "shooter": shooter, "goalieId": goalieId, "goalie": goalie})
+    return df.assign(**players_dtypes(players))
 
 
 def create_dataframe_from_game(game_id:str, use_cache=True):
     helper = FetchData()
     data = helper.get_play_by_play(game_id, use_cache=use_cache)
-        
-    allPlays_columns = [
-    #     'result.event', 'result.eventCode', 
-        'result.eventTypeId', # 'result.description', 
-        'about.eventIdx', # 'about.eventId', 
-        'about.period', 'about.periodType', # 'about.ordinalNum', 
-        'about.periodTime', 'about.periodTimeRemaining',
-        #'about.dateTime', 'about.goals.away', 'about.goals.home', 
-        'players', 'coordinates.x', 'coordinates.y',
-        # 'team.id', 'team.name', 'team.link', 
-        'team.triCode',
-        'result.secondaryType', # 'result.penaltySeverity', 'result.penaltyMinutes', 
-        # 'result.strength.code', # 'result.strength.name','result.gameWinningGoal', 
-        'result.emptyNet'
-    ]
-    allPlays_columns_map = {
-        'result.eventTypeId'       : "eventType", 
-        'about.eventIdx'           : "eventIdx", 
-        'about.period'             : "period", 
-        'about.periodType'         : "periodType", 
-        'about.periodTime'         : "periodTimeSec", 
-        'about.periodTimeRemaining': "periodTimeRem",
-        'players'                  : "players", 
-        'coordinates.x'            : "coordinate_x", 
-        'coordinates.y'            : "coordinate_y",
-        'result.secondaryType'     : "shotType",
-        'team.triCode'             : "teamTriCode",
-        # 'result.strength.code'     : "shotStrength", 
-        'result.emptyNet'          : "emptyNet"
-    }
     
     #load exceptions
     try:
-        df = pd.json_normalize(data["liveData"]["plays"]["allPlays"])
-    except: return None
+        df = parse_plays(data["liveData"]["plays"]["allPlays"])
+    except (KeyError, TypeError): return None
     if df.empty: return None 
     
-    if "result.emptyNet" not in df.columns:
-        df["result.emptyNet"] = None
-    
-    
-    df = df[allPlays_columns]
-    df = df.rename(allPlays_columns_map, axis=1)
     df["gameId"] = game_id
     
     #rinkSide
     df = add_rinkSide(df, data)
     df = add_features_set1(df)
-#     df = add_players(df)
     df["emptyNet"] = df.emptyNet.fillna(False)
     df["emptyNet"] = df.emptyNet.astype(int)
 
@@ -202,7 +286,7 @@ def create_dataframe_from_game(game_id:str, use_cache=True):
         "eventIdx", 
         "period", 
         "periodType", "periodTimeSec", "periodTimeRem",
-#         "shooter", "goalie",
+        "shooterId", "shooter", "goalieId", "goalie",
 #         "players", 
         "coordinate_x", "coordinate_y",
         "shotType",
@@ -244,15 +328,23 @@ def aug2(df, call_full=True):
     else:
         return df[colns]
 
-def aug3(df, full_model):
+def aug3(df, full_model=True, model_name=None):
     """
     Added to directly preprocess into XGBoost compatible data.
     Note: individual games don't map out the support of 'shotType' and 'lastEventType'
     which means that certain values will not be orthogonalized, and therefore needs to be added 
     manually to cover for the one hot encoder.
+    The returned columns are 'isGoal' followed by the schema of the model (see feature_schema),
+    given by model_name, or by full_model (all features or select features) if model_name is None.
     """
+    if model_name is None:
+        model_name = 'xgboost-best-all-features' if full_model else 'xgboost-best-select-features'
+
     df = aug2(df, call_full=False)
     df = df.dropna()#.reset_index()
+    if df.empty:
+        # e.g. new shots of a live game without previous event
+        return pd.DataFrame(columns=['isGoal'] + get_columns(model_name))
 
     shotType_support = [
         'Backhand', 'Deflected', 'Slap Shot', 
@@ -284,18 +376,5 @@ def aug3(df, full_model):
     df = pd.concat([df, shot_df, event_df], axis=1)
     df = df.drop(["shotType", "lastEventType"], axis=1)
     
-    df = df[['isGoal', 'periodTimeSec', 'period', 'coordinate_x', 'coordinate_y',
-       'distanceFromGoal', 'shotAngle', 'lastEventCoord_x', 'lastEventCoord_y',
-       'timeDifference', 'distanceDifference', 'rebound',
-       'shotAngleDifference', 'speed', 'Backhand', 'Deflected', 'Slap Shot',
-       'Snap Shot', 'Tip-In', 'Wrap-around', 'Wrist Shot', 'BLOCKED_SHOT',
-       'FACEOFF', 'GIVEAWAY', 'GOAL', 'HIT', 'MISSED_SHOT', 'PENALTY', 'SHOT',
-       'TAKEAWAY']]
-    
-    if full_model:
-        return df
-    
-    # isGoal should not have been there at any point
-    X = df.drop(columns=['PENALTY', 'lastEventCoord_x'], errors='ignore')
-    
-    return X
\ No newline at end of file
+    # isGoal is kept as the first column, it is dropped by the ServingClient
+    return df[['isGoal'] + get_columns(model_name)]
@@ -0,0 +1,299 @@
+"""
+Replays cached games as if they were live, through a local stand-in for the live feed endpoint
+of the NHL API, to test and benchmark the live path (GameClient, ServingClient) offline.
+
+Serve the cached games of a season 60 times faster than real time:
+
+    $ python -m ift6758.data.replay serve --season 2016 --speed 60 --port 8000
+
+Then point the fetch layer of the clients (streamlit app, serving app) to it. NHL_FORCE_LIVE=1
+makes them refresh the feeds of the old games, which are otherwise final, and separate feed,
+features and game index folders keep the replayed (partial) games away from the cached ones
+(serve prints these exports):
+
+    $ export NHL_API_URL=http://localhost:8000/api/v1 NHL_FORCE_LIVE=1 \
+        NHL_DATA_DIR=/tmp/replay/raw NHL_FEATURES_DIR=/tmp/replay/features \
+        NHL_GAME_INDEX=/tmp/replay/games.sqlite
+
+Or run the server and N simultaneous live game clients in one process:
+
+    $ python -m ift6758.data.replay bench --season 2016 --games 50 --speed 600 --interval 1
+"""
+import argparse
+import bisect
+import contextlib
+import copy
+import glob
+import json
+import os
+import re
+import statistics
+import tempfile
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+from ift6758.data import fetch_data
+
+
+# Real duration used to spread the plays of a feed that has no play timestamps
+DEFAULT_GAME_DURATION = 9000
+
+FEED_URL = re.compile(r"^/api/v1/game/(\d+)/feed/live/?$")
+
+
+class ReplayGame:
+    def __init__(self, data: dict, speed=1.0, duration=DEFAULT_GAME_DURATION):
+        """
+        A cached game replayed progressively: the plays are revealed at the pace they happened
+        (from their about.dateTime), speed times faster. The replay clock of the game starts at
+        its first request.
+        Args:
+            data (dict): complete live feed of the game
+            speed (float): speed-up of the replay
+            duration (float): real duration of the game, in seconds, when the plays have no dateTime
+        """
+        self.data = data
+        self.plays = data["liveData"]["plays"]["allPlays"]
+        self.speed = speed
+        self.offsets = self.play_offsets(duration)
+        self.start = None
+        self.lock = threading.Lock()
+        # (number of revealed plays, serialized feed) last served, shared by all the clients
+        self.last_response = (None, None)
+
+    def play_offsets(self, duration):
+        """Seconds between the first play and each play."""
+        try:
+            times = [datetime.strptime(p["about"]["dateTime"], "%Y-%m-%dT%H:%M:%SZ") for p in self.plays]
+            return [(t - times[0]).total_seconds() for t in times]
+        except (KeyError, ValueError, IndexError):
+            n = max(len(self.plays) - 1, 1)
+            return [i * duration / n for i in range(len(self.plays))]
+
+    def n_revealed(self):
+        """Number of plays revealed so far (starts the replay clock on the first call)."""
+        with self.lock:
+            if self.start is None:
+                self.start = time.monotonic()
+        elapsed = (time.monotonic() - self.start) * self.speed
+        # first play revealed right away
+        return max(bisect.bisect_right(self.offsets, elapsed), 1) if self.plays else 0
+
+    def feed(self, n: int):
+        """The live feed as it was when only the first n plays had happened."""
+        data = copy.copy(self.data)
+        data["gameData"] = copy.copy(self.data["gameData"])
+        data["liveData"] = copy.copy(self.data["liveData"])
+        plays = self.plays[:n]
+        ended = n == len(self.plays)
+        data["gameData"]["status"] = dict(
+            self.data["gameData"].get("status", {}),
+            abstractGameState="Final" if ended else ("Live" if n else "Preview"),
+        )
+        data["liveData"]["plays"] = dict(
+            self.data["liveData"]["plays"],
+            allPlays=plays,
+            currentPlay=plays[-1] if plays else {},
+            scoringPlays=[i for i in self.data["liveData"]["plays"].get("scoringPlays", []) if i < n],
+        )
+        linescore = self.data["liveData"].get("linescore")
+        if linescore is not None and plays:
+            current = plays[-1]["about"]
+            linescore = dict(
+                linescore,
+                currentPeriod=current["period"],
+                periods=[p for p in linescore.get("periods", []) if p["num"] <= current["period"]],
+            )
+            if "goals" in current:
+                linescore["teams"] = {
+                    side: dict(linescore["teams"][side], goals=current["goals"][side])
+                    for side in ("away", "home")
+                }
+            data["liveData"]["linescore"] = linescore
+        return data
+
+    def response(self):
+        """Serialized live feed at the current replay time."""
+        n = self.n_revealed()
+        last_n, body = self.last_response
+        if last_n != n:
+            body = json.dumps(self.feed(n)).encode()
+            self.last_response = (n, body)
+        return body
+
+
+def load_games(files: list, speed=1.0):
+    """
+    Loads cached feeds (files <game_id>.json) into ReplayGames.
+    Returns:
+        games: dict of game ID -> ReplayGame
+    """
+    games = {}
+    for file in files:
+        with open(file, "r") as f:
+            data = json.load(f)
+        if "liveData" not in data:
+            # error payload cached in place of a game
+            continue
+        games[os.path.basename(file)[:-len(".json")]] = ReplayGame(data, speed=speed)
+    return games
+
+
+def season_files(year: int, path=None):
+    """Cached feeds of the regular season and playoff games of the <year/year+1> season."""
+    path = fetch_data.RAW_DATA_PATH if path is None else path
+    return sorted(glob.glob(os.path.join(path, "{}0[23]*.json".format(year))))
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    # set by make_server
+    games = {}
+
+    def do_GET(self):
+        match = FEED_URL.match(self.path)
+        if match and match.group(1) in self.games:
+            body = self.games[match.group(1)].response()
+            self.send_response(200)
+        elif self.path == "/replay/status":
+            body = json.dumps({
+                game_id: {'revealed': game.n_revealed() if game.start else 0, 'plays': len(game.plays)}
+                for game_id, game in self.games.items()
+            }).encode()
+            self.send_response(200)
+        else:
+            # same payload as the NHL API for an unknown game
+            body = json.dumps({"messageNumber": 2, "message": "Game data couldn't be found"}).encode()
+            self.send_response(404)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_server(games: dict, host="127.0.0.1", port=8000):
+    """
+    Creates the replay server of the given games (see load_games); call serve_forever() to run it.
+    Its live feed endpoint is http://host:port/api/v1/game/<game_id>/feed/live/
+    """
+    handler = type("Handler", (ReplayHandler,), {'games': games})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def benchmark(games: dict, clients_per_game=1, interval=1.0, port=8000, serving_client=None, model_name=None):
+    """
+    Replays the games and polls each of them with clients_per_game GameClients (one thread each),
+    every interval seconds, until all the games ended. The new shots are scored with
+    serving_client if given.
+    Returns:
+        stats: dict with the number of polls, shots, the poll latencies and the client errors
+    """
+    from ift6758.client.game_client import GameClient
+    from ift6758.data import feature_cache, fetcher, game_index
+
+    model_name = model_name or "xgboost-best-all-features"
+
+    latencies = []
+    shots = []
+    errors = []
+    lock = threading.Lock()
+
+    def client(game_id):
+        game_client = GameClient(use_cache=False)
+        while True:
+            start = time.perf_counter()
+            try:
+                df = game_client.process_query(game_id, model_name=model_name)
+                if df is not None and serving_client is not None:
+                    serving_client.predict(df)
+            except Exception as e:
+                with lock:
+                    errors.append(f"{game_id}: {e!r}")
+                return
+            with lock:
+                latencies.append(time.perf_counter() - start)
+                shots.append(0 if df is None else len(df))
+            if game_client.game_ended:
+                return
+            time.sleep(interval)
+
+    server = make_server(games, port=port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    # the settings of the fetch layer are patched for the benchmark only, and restored even if it fails
+    with contextlib.ExitStack() as stack:
+        stack.callback(server.server_close)
+        stack.callback(server.shutdown)
+        # the replayed feeds must not overwrite the cached ones, nor their metadata
+        raw_data_path = stack.enter_context(tempfile.TemporaryDirectory(prefix="replay_"))
+        stack.enter_context(mock.patch.object(fetch_data, "NHL_API_URL", "http://127.0.0.1:{}/api/v1".format(port)))
+        stack.enter_context(mock.patch.object(fetch_data, "RAW_DATA_PATH", raw_data_path))
+        index_db = os.path.join(raw_data_path, "games.sqlite")
+        stack.enter_context(mock.patch.object(game_index, "INDEX_DB", index_db))
+        stack.callback(game_index.indexes.pop, index_db, None)
+        stack.enter_context(mock.patch.object(feature_cache, "FEATURES_PATH", os.path.join(raw_data_path, "features")))
+        # the local server does not need the rate limit of the NHL API
+        stack.enter_context(mock.patch.dict(fetcher.fetchers, {"default": fetcher.Fetcher(rate=10000, burst=10000)}))
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=client, args=(game_id,))
+                   for game_id in games for _ in range(clients_per_game)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'clients': len(threads),
+        'elapsed': elapsed,
+        'polls': len(latencies),
+        'polls_per_sec': len(latencies) / elapsed if elapsed > 0 else 0.0,
+        'shots': sum(shots),
+        'shots_per_sec': sum(shots) / elapsed if elapsed > 0 else 0.0,
+        # None when no poll succeeded (all failed, or no games)
+        'poll_p50': statistics.median(latencies) if latencies else None,
+        'poll_p95': latencies[int(0.95 * (len(latencies) - 1))] if latencies else None,
+        'errors': errors,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay cached games through a local live feed endpoint.")
+    parser.add_argument("command", choices=["serve", "bench"])
+    parser.add_argument("--files", nargs="*", default=[], help="cached feeds <game_id>.json to replay")
+    parser.add_argument("--season", type=int, help="replay the cached games of this season")
+    parser.add_argument("--path", default=None, help="folder of the cached feeds of --season")
+    parser.add_argument("--games", type=int, default=None, help="only replay the first N games")
+    parser.add_argument("--speed", type=float, default=60, help="speed-up of the replay")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--clients", type=int, default=1, help="bench: clients polling each game")
+    parser.add_argument("--interval", type=float, default=1.0, help="bench: seconds between polls")
+    parser.add_argument("--serving", default=None, help="bench: score the shots with the serving app at ip:port")
+    args = parser.parse_args()
+
+    files = list(args.files)
+    if args.season is not None:
+        files += season_files(args.season, args.path)
+    games = load_games(files[:args.games], speed=args.speed)
+    print(f"Replaying {len(games)} games at x{args.speed}")
+
+    if args.command == "serve":
+        replay_dir = os.path.join(tempfile.gettempdir(), "replay")
+        print("Point the clients to the replay with:")
+        print(f"    export NHL_API_URL=http://localhost:{args.port}/api/v1 NHL_FORCE_LIVE=1 "
+              f"NHL_DATA_DIR={os.path.join(replay_dir, 'raw')} NHL_FEATURES_DIR={os.path.join(replay_dir, 'features')} "
+              f"NHL_GAME_INDEX={os.path.join(replay_dir, 'games.sqlite')}")
+        make_server(games, host="0.0.0.0", port=args.port).serve_forever()
+    else:
+        serving_client = None
+        if args.serving:
+            from ift6758.client.serving_client import ServingClient
+            ip, port = args.serving.split(":")
+            serving_client = ServingClient(ip=ip, port=int(port))
+        print(json.dumps(benchmark(games, args.clients, args.interval, args.port, serving_client), indent=2))
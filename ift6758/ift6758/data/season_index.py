@@ -0,0 +1,204 @@
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from ift6758.data.fetcher import FetchError, get_fetcher
+
+
+SCHEDULE_URL = "https://statsapi.web.nhl.com/api/v1/schedule"
+INDEX_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../../data/index/"))
+# Hours after which the index of the season in progress is rebuilt, to list the games scheduled since
+INDEX_MAX_AGE = float(os.environ.get("NHL_INDEX_MAX_AGE", 6))
+
+logger = logging.getLogger(__name__)
+
+# Schedule API game types, and the corresponding 2 digits of the game IDs
+GAME_TYPES = {
+    'PR': '01',  # preseason
+    'R': '02',   # regular season
+    'P': '03',   # playoffs
+}
+
+
+def season_index_path(year: int, path=INDEX_PATH):
+    """
+    Returns the path of the index file of the <year/year+1> season.
+    """
+    return "{}/{}.json".format(path, year)
+
+
+def current_season():
+    """
+    Returns the first year of the season in progress (or of the next one, in the summer): the
+    seasons start in October and end in June.
+    """
+    now = datetime.utcnow()
+    return now.year if now.month >= 7 else now.year - 1
+
+
+def is_stale(index: dict, max_age=INDEX_MAX_AGE):
+    """
+    Whether an index (see load_season_index) may miss games: an index of the current season (or a
+    later one) built more than max_age hours ago. The indexes of the past seasons are final.
+    """
+    if index["year"] < current_season():
+        return False
+    age = datetime.utcnow() - datetime.fromisoformat(index["built"])
+    return age.total_seconds() > max_age * 3600
+
+
+def fetch_schedule(year: int, game_type: str):
+    """
+    Gets every game of the <year/year+1> season of the given type from the schedule API.
+    Unlike the IDs generated by FetchData.game_ids_*, only games that actually exist are returned
+    (e.g. no playoff game 7 that was never played).
+    Args:
+        year (int): The first year of the season to retrieve, i.e. for the 2016-17
+            season you'd put in 2016
+        game_type (str): schedule API game type, one of the keys of GAME_TYPES
+    Returns:
+        games: dict of game ID -> {type, date, status, away, home}
+    """
+    params = {
+        'season': "{}{}".format(year, year + 1),
+        'gameType': game_type,
+        'expand': 'schedule.teams',
+    }
+    status, data = get_fetcher().get_json(SCHEDULE_URL, params=params)
+    if status != 200:
+        raise FetchError("schedule of {} {}: HTTP {}".format(year, game_type, status))
+
+    games = {}
+    for date in data.get("dates", []):
+        for game in date["games"]:
+            game_id = str(game["gamePk"])
+            # The schedule of a season may list games of another type (e.g. all-star)
+            if game_id[4:6] != GAME_TYPES[game_type]:
+                continue
+            games[game_id] = {
+                'type': game_type,
+                'date': date["date"],
+                'status': game["status"]["detailedState"],
+                'away': game["teams"]["away"]["team"].get("abbreviation"),
+                'home': game["teams"]["home"]["team"].get("abbreviation"),
+            }
+    return games
+
+
+def build_season_index(years: list, game_types=('R', 'P'), path=INDEX_PATH, workers=8, refresh=False):
+    """
+    Builds the index of the existing games of each season, with their status, date and teams,
+    and saves it at path/<year>.json. The schedule of every (season, game type) is fetched in
+    parallel. Existing index files are kept unless refresh is True, or they are stale (see
+    is_stale): a stale index is then kept only if its schedule cannot be fetched.
+    Args:
+        years (list): first years of the seasons to index
+        game_types (tuple): schedule API game types to index (see GAME_TYPES)
+        path: folder of the index files
+        workers (int): number of schedule requests run in parallel
+        refresh (bool): rebuild the index files that already exist
+    Returns:
+        indexes: dict of year -> index (see load_season_index)
+    """
+    # fetch_data imports this module
+    from ift6758.data.fetch_data import write_json_atomic
+
+    indexes = {}
+    to_build = []
+    # stale indexes being rebuilt, used if the API is down
+    stale = {}
+    for year in years:
+        index = None if refresh else load_season_index(year, path)
+        if index is not None and all(t in index["gameTypes"] for t in game_types):
+            if not is_stale(index):
+                indexes[year] = index
+                continue
+            stale[year] = index
+        to_build.append(year)
+
+    def fetch(job):
+        try:
+            return fetch_schedule(*job)
+        except FetchError as e:
+            if job[0] not in stale:
+                raise
+            return e
+
+    jobs = [(year, game_type) for year in to_build for game_type in game_types]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        schedules = list(executor.map(fetch, jobs))
+
+    os.makedirs(path, exist_ok=True)
+    for year in to_build:
+        games = {}
+        errors = []
+        for (job_year, _), schedule in zip(jobs, schedules):
+            if job_year != year:
+                continue
+            if isinstance(schedule, FetchError):
+                errors.append(schedule)
+            else:
+                games.update(schedule)
+        if errors:
+            logger.warning("Could not refresh the index of %s, using the one built at %s: %s",
+                           year, stale[year]["built"], errors[0])
+            indexes[year] = stale[year]
+            continue
+        index = {
+            'year': year,
+            'gameTypes': list(game_types),
+            'built': datetime.utcnow().isoformat(timespec="seconds"),
+            'games': dict(sorted(games.items())),
+        }
+        # read concurrently by existing_game_ids (e.g. downloads): never a truncated file
+        write_json_atomic(season_index_path(year, path), index)
+        indexes[year] = index
+    return indexes
+
+
+def load_season_index(year: int, path=INDEX_PATH):
+    """
+    Loads the index of the <year/year+1> season built by build_season_index.
+    Returns:
+        index: dict with keys year, gameTypes, built and games (game ID -> metadata),
+            or None if the season was not indexed
+    """
+    if not os.path.exists(season_index_path(year, path)):
+        return None
+    with open(season_index_path(year, path), "r") as f:
+        return json.load(f)
+
+
+def existing_game_ids(year: int, game_type: str, path=INDEX_PATH, build=True, refresh=False):
+    """
+    Returns the sorted list of the game IDs of the <year/year+1> season and game type that
+    actually exist, building the season index if needed, or rebuilding it if it is stale (see
+    is_stale).
+    Args:
+        year (int): The first year of the season
+        game_type (str): schedule API game type, one of the keys of GAME_TYPES
+        path: folder of the index files
+        build (bool): build the index if it does not exist or is stale, otherwise return None
+            (or the IDs of the stale index)
+        refresh (bool): rebuild the index even if it is up to date
+    Returns:
+        IDs: list of game IDs, or None if the season is not indexed and build is False
+    """
+    index = None if refresh else load_season_index(year, path)
+    missing = index is None or game_type not in index["gameTypes"]
+    if missing or is_stale(index):
+        if build:
+            index = build_season_index([year], game_types=tuple(sorted(set(['R', 'P', game_type]))), path=path,
+                                       refresh=refresh)[year]
+        elif missing:
+            return None
+    return [game_id for game_id, game in index["games"].items() if game["type"] == game_type]
+
+
+if __name__ == "__main__":
+    # Index the seasons used to train the models
+    indexes = build_season_index([2015, 2016, 2017, 2018, 2019, 2020, 2021])
+    for year, index in indexes.items():
+        print(year, len(index["games"]), "games")
@@ -0,0 +1,272 @@
+"""
+Generator of synthetic NHL live feeds, with the schema of the statsapi live feed endpoint
+(the fields read by create_dataframe_from_game, add_rinkSide, get_scores, get_period_info and
+the game index), to stress the featurization and serving paths at any volume, reproducibly.
+
+Write a season of 1271 games of 3000 events each to /tmp/synthetic:
+
+    $ python -m ift6758.data.synthetic --year 2030 --games 1271 --events 3000 --path /tmp/synthetic
+
+The generated feeds can be replayed with replay.py, or loaded with FetchData.get_play_by_play
+(path=... or NHL_DATA_DIR) since they are written as <game_id>.json.
+"""
+import argparse
+import json
+import math
+import os
+import random
+from datetime import datetime, timedelta
+
+
+TEAMS = [
+    ("ANA", "Anaheim Ducks"), ("ARI", "Arizona Coyotes"), ("BOS", "Boston Bruins"),
+    ("BUF", "Buffalo Sabres"), ("CGY", "Calgary Flames"), ("CAR", "Carolina Hurricanes"),
+    ("CHI", "Chicago Blackhawks"), ("COL", "Colorado Avalanche"), ("CBJ", "Columbus Blue Jackets"),
+    ("DAL", "Dallas Stars"), ("DET", "Detroit Red Wings"), ("EDM", "Edmonton Oilers"),
+    ("FLA", "Florida Panthers"), ("LAK", "Los Angeles Kings"), ("MIN", "Minnesota Wild"),
+    ("MTL", "Montréal Canadiens"), ("NSH", "Nashville Predators"), ("NJD", "New Jersey Devils"),
+    ("NYI", "New York Islanders"), ("NYR", "New York Rangers"), ("OTT", "Ottawa Senators"),
+    ("PHI", "Philadelphia Flyers"), ("PIT", "Pittsburgh Penguins"), ("SJS", "San Jose Sharks"),
+    ("SEA", "Seattle Kraken"), ("STL", "St. Louis Blues"), ("TBL", "Tampa Bay Lightning"),
+    ("TOR", "Toronto Maple Leafs"), ("VAN", "Vancouver Canucks"), ("VGK", "Vegas Golden Knights"),
+    ("WSH", "Washington Capitals"), ("WPG", "Winnipeg Jets"),
+]
+
+# Event types of the plays with their frequency, roughly as in real games
+EVENT_TYPES = [
+    ("FACEOFF", "Faceoff", 0.12), ("SHOT", "Shot", 0.20), ("MISSED_SHOT", "Missed Shot", 0.10),
+    ("BLOCKED_SHOT", "Blocked Shot", 0.10), ("HIT", "Hit", 0.18), ("GIVEAWAY", "Giveaway", 0.06),
+    ("TAKEAWAY", "Takeaway", 0.05), ("GOAL", "Goal", 0.02), ("PENALTY", "Penalty", 0.03),
+    ("STOP", "Stoppage", 0.14),
+]
+
+SHOT_TYPES = ['Backhand', 'Deflected', 'Slap Shot', 'Snap Shot', 'Tip-In', 'Wrap-around', 'Wrist Shot']
+
+# Types of the players involved in each event type (the first one is the acting team's player)
+PLAYER_TYPES = {
+    "FACEOFF": ["Winner", "Loser"], "SHOT": ["Shooter", "Goalie"], "MISSED_SHOT": ["Shooter"],
+    "BLOCKED_SHOT": ["Blocker", "Shooter"], "HIT": ["Hitter", "Hittee"], "GIVEAWAY": ["PlayerID"],
+    "TAKEAWAY": ["PlayerID"], "GOAL": ["Scorer", "Assist", "Goalie"], "PENALTY": ["PenaltyOn", "DrewBy"],
+}
+
+# Missing field rates of the generated feeds, see generate_game
+DEFAULT_MISSING_RATES = {
+    'linescore': 0.0,        # no liveData.linescore at all (get_scores falls back to currentPlay)
+    'rinkSide': 0.05,        # linescore periods without rinkSide (add_rinkSide infers it)
+    'emptyNet': 0.1,         # goal without result.emptyNet
+    'coordinates': 0.01,     # event without coordinates
+    'secondaryType': 0.01,   # shot or goal without result.secondaryType
+}
+
+
+def player(rng, team_index, player_type):
+    # 30 skaters and the goalie (number 0) per team, with stable IDs and names
+    number = 0 if player_type == "Goalie" else rng.randint(1, 30)
+    player_id = 8400000 + 100 * team_index + number
+    return {
+        "player": {"id": player_id, "fullName": "Player {}".format(player_id), "link": "/api/v1/people/{}".format(player_id)},
+        "playerType": player_type,
+    }
+
+
+def generate_game(game_id: str, n_events=300, seed=0, missing_rates=None, live=False):
+    """
+    Generates the live feed of a game.
+    Args:
+        game_id (str): game ID, YYYYTTNNNN (the season, game type and date are derived from it)
+        n_events (int): number of plays (real games have 300 to 400)
+        seed (int): random seed; the same (game_id, n_events, seed, missing_rates) gives the same feed
+        missing_rates (dict): probability of each missing field, see DEFAULT_MISSING_RATES
+        live (bool): generate a game in progress (no GAME_END, 'Live' status)
+    Returns:
+        data: live feed dict
+    """
+    rates = dict(DEFAULT_MISSING_RATES, **(missing_rates or {}))
+    rng = random.Random("{}-{}-{}".format(game_id, n_events, seed))
+    year = int(str(game_id)[:4])
+    game_number = int(str(game_id)[6:])
+
+    away_index, home_index = rng.sample(range(len(TEAMS)), 2)
+    teams = {"away": away_index, "home": home_index}
+    start = datetime(year, 10, 1, 23) + timedelta(days=(game_number * 180) // 1300)
+
+    # Side of the rink defended by the home team in odd periods
+    home_side = rng.choice(["left", "right"])
+    other_side = {"left": "right", "right": "left"}
+
+    n_periods = 3
+    types, names, weights = zip(*EVENT_TYPES)
+    plays = []
+    goals = {"away": 0, "home": 0}
+    scoring_plays = []
+
+    def add_play(event_type, event_name, period, period_time, team=None, **result):
+        about = {
+            "eventIdx": len(plays),
+            "eventId": len(plays) + 1,
+            "period": period,
+            "periodType": "REGULAR",
+            "ordinalNum": ["1st", "2nd", "3rd"][period - 1],
+            "periodTime": "{:02d}:{:02d}".format(*divmod(period_time, 60)),
+            "periodTimeRemaining": "{:02d}:{:02d}".format(*divmod(1200 - period_time, 60)),
+            "dateTime": (start + timedelta(seconds=(period - 1) * 2400 + period_time * 1.5)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "goals": dict(goals),
+        }
+        play = {
+            "result": dict({"event": event_name, "eventCode": "{}{}".format(game_id[-4:], len(plays)),
+                            "eventTypeId": event_type, "description": event_name}, **result),
+            "about": about,
+            "coordinates": {},
+        }
+        if team is not None:
+            team_index = teams[team]
+            play["team"] = {"id": team_index + 1, "name": TEAMS[team_index][1], "link": "/api/v1/teams/{}".format(team_index + 1),
+                            "triCode": TEAMS[team_index][0]}
+            play["players"] = [
+                player(rng, team_index if i == 0 or player_type == "Assist" else teams[other_team(team)], player_type)
+                for i, player_type in enumerate(PLAYER_TYPES.get(event_type, []))
+            ]
+            if rng.random() >= rates['coordinates']:
+                play["coordinates"] = coordinates(rng, event_type, period, team)
+        plays.append(play)
+        return play
+
+    def other_team(team):
+        return "home" if team == "away" else "away"
+
+    def coordinates(rng, event_type, period, team):
+        # side attacked by the team: the opposite of the side it defends
+        home_defends = home_side if period % 2 == 1 else other_side[home_side]
+        defends = home_defends if team == "home" else other_side[home_defends]
+        sign = 1 if defends == "left" else -1
+        if event_type in ("SHOT", "GOAL", "MISSED_SHOT", "BLOCKED_SHOT"):
+            distance = rng.gammavariate(2.0, 12.0 if event_type == "GOAL" else 18.0)
+            angle = rng.uniform(-math.pi / 2.2, math.pi / 2.2)
+            x = 89 - distance * math.cos(angle)
+            y = distance * math.sin(angle)
+            return {"x": float(round(sign * max(x, -99))), "y": float(round(max(min(y, 42), -42)))}
+        return {"x": float(rng.randint(-99, 99)), "y": float(rng.randint(-42, 42))}
+
+    events_per_period = max(n_events - 2 * n_periods - 2, n_periods) // n_periods
+    n_played = n_periods
+    if live:
+        # stop in the middle of the game
+        n_played = rng.randint(1, n_periods)
+    add_play("GAME_SCHEDULED", "Game Scheduled", 1, 0)
+    for period in range(1, n_played + 1):
+        add_play("PERIOD_START", "Period Start", period, 0)
+        n_period_events = events_per_period if not (live and period == n_played) else rng.randint(1, events_per_period)
+        period_times = sorted(rng.randint(0, 1199) for _ in range(n_period_events))
+        for period_time in period_times:
+            event_type = rng.choices(types, weights)[0]
+            event_name = names[types.index(event_type)]
+            if event_type == "STOP":
+                add_play(event_type, event_name, period, period_time)
+                continue
+            team = rng.choice(["away", "home"])
+            result = {}
+            if event_type in ("SHOT", "GOAL") and rng.random() >= rates['secondaryType']:
+                result["secondaryType"] = rng.choice(SHOT_TYPES)
+            if event_type == "GOAL":
+                goals[team] += 1
+                result["strength"] = {"code": "EVEN", "name": "Even Strength"}
+                result["gameWinningGoal"] = False
+                if rng.random() >= rates['emptyNet']:
+                    result["emptyNet"] = rng.random() < 0.05
+                scoring_plays.append(len(plays))
+            if event_type == "PENALTY":
+                result.update(penaltySeverity="Minor", penaltyMinutes=2, secondaryType="Tripping")
+            add_play(event_type, event_name, period, period_time, team, **result)
+        if not (live and period == n_played):
+            add_play("PERIOD_END", "Period End", period, 1200)
+    if not live:
+        add_play("GAME_END", "Game End", n_periods, 1200)
+
+    current_period = plays[-1]["about"]["period"]
+    periods = []
+    for period in range(1, current_period + 1):
+        home_period_side = home_side if period % 2 == 1 else other_side[home_side]
+        periods.append({
+            "periodType": "REGULAR", "num": period, "ordinalNum": ["1st", "2nd", "3rd"][period - 1],
+            "home": {"goals": 0, "shotsOnGoal": 0, "rinkSide": home_period_side},
+            "away": {"goals": 0, "shotsOnGoal": 0, "rinkSide": other_side[home_period_side]},
+        })
+    if rng.random() < rates['rinkSide']:
+        for period in periods:
+            del period["home"]["rinkSide"]
+            del period["away"]["rinkSide"]
+
+    live_data = {
+        "plays": {"allPlays": plays, "scoringPlays": scoring_plays, "currentPlay": plays[-1]},
+    }
+    if rng.random() >= rates['linescore']:
+        live_data["linescore"] = {
+            "currentPeriod": current_period,
+            "periods": periods,
+            "teams": {
+                side: {"team": {"id": teams[side] + 1, "name": TEAMS[teams[side]][1]}, "goals": goals[side], "shotsOnGoal": 0}
+                for side in ("away", "home")
+            },
+        }
+
+    state = "Live" if live else "Final"
+    return {
+        "gamePk": int(game_id),
+        "gameData": {
+            "game": {"pk": int(game_id), "season": "{}{}".format(year, year + 1), "type": "R" if str(game_id)[4:6] == "02" else "P"},
+            "datetime": {"dateTime": start.strftime("%Y-%m-%dT%H:%M:%SZ")},
+            "status": {"abstractGameState": state, "detailedState": "In Progress" if live else "Final"},
+            "teams": {
+                side: {"id": teams[side] + 1, "name": TEAMS[teams[side]][1], "triCode": TEAMS[teams[side]][0],
+                       "abbreviation": TEAMS[teams[side]][0]}
+                for side in ("away", "home")
+            },
+        },
+        "liveData": live_data,
+    }
+
+
+def generate_season(year: int, n_games=1271, n_events=300, path=None, seed=0, missing_rates=None):
+    """
+    Generates the regular season games <year>020001 to <year>02<n_games> and writes them as
+    path/<game_id>.json (only returns them if path is None).
+    Args:
+        year (int): first year of the season
+        n_games (int): number of games, at most 9999 (4 digits of the game IDs); use several
+            years for more games
+        n_events (int): number of plays per game
+        path: folder in which the feeds are written, created if needed
+        seed (int): random seed
+        missing_rates (dict): see generate_game
+    Returns:
+        game IDs (list) if path is given, else dict of game ID -> feed
+    """
+    if not 0 < n_games < 10000:
+        raise ValueError("n_games must be between 1 and 9999")
+    game_ids = [str(year) + "02" + '{:04d}'.format(i) for i in range(1, n_games + 1)]
+    if path is None:
+        return {game_id: generate_game(game_id, n_events, seed, missing_rates) for game_id in game_ids}
+
+    os.makedirs(path, exist_ok=True)
+    for game_id in game_ids:
+        with open(os.path.join(path, "{}.json".format(game_id)), "w") as f:
+            json.dump(generate_game(game_id, n_events, seed, missing_rates), f)
+    return game_ids
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic NHL live feeds.")
+    parser.add_argument("--year", type=int, nargs="+", default=[2030], help="seasons to generate")
+    parser.add_argument("--games", type=int, default=1271, help="games per season")
+    parser.add_argument("--events", type=int, default=300, help="plays per game")
+    parser.add_argument("--path", required=True, help="output folder")
+    parser.add_argument("--seed", type=int, default=0)
+    for field, rate in DEFAULT_MISSING_RATES.items():
+        parser.add_argument("--missing-" + field, type=float, default=rate, dest=field,
+                            help="rate of feeds/plays without {} (default {})".format(field, rate))
+    args = parser.parse_args()
+
+    rates = {field: getattr(args, field) for field in DEFAULT_MISSING_RATES}
+    for year in args.year:
+        game_ids = generate_season(year, args.games, args.events, args.path, args.seed, rates)
+        print(year, len(game_ids), "games written to", args.path)
@@ -0,0 +1,365 @@
+"""
+Work queue of the games to download and featurize, so that a backfill can be spread over worker
+processes. The queue is a SQLite database: workers lease tasks for a limited time, a task whose
+worker died is leased again once its lease expired, and failed tasks are retried a few times.
+
+SQLite relies on the file locks of the filesystem: the workers must run on the host of the queue
+file, or on hosts sharing a filesystem whose locks are reliable (a local disk, or e.g. a cluster
+filesystem with POSIX locks). NFS and most network shares do not lock reliably, and can corrupt
+the queue: use a server-based queue for workers on several machines sharing such a folder. The
+queue uses a rollback journal, since WAL mode needs shared memory between the processes and does
+not work across hosts at all.
+
+Enqueue the games of some seasons, then start workers (on each node):
+
+    $ python -m ift6758.data.work_queue enqueue 2015 2016 2017
+    $ python -m ift6758.data.work_queue work --processes 4
+    $ python -m ift6758.data.work_queue status
+
+The feeds and features are written to NHL_DATA_DIR and NHL_FEATURES_DIR, and the queue is
+NHL_WORK_QUEUE.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+QUEUE_DB = os.environ.get(
+    "NHL_WORK_QUEUE", os.path.abspath(os.path.join(os.path.dirname(__file__), "../../../data/queue.sqlite"))
+)
+
+# Seconds a task is leased to a worker before another worker can take it
+LEASE_SECONDS = 300
+MAX_ATTEMPTS = 3
+# Seconds before a failed task can be leased again (times the number of attempts)
+RETRY_DELAY = 30
+
+
+class WorkQueue:
+    def __init__(self, path=None, lease_seconds=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS, retry_delay=RETRY_DELAY):
+        """
+        SQLite work queue of game tasks, with leases, retries and completion tracking.
+        Args:
+            path: path of the SQLite database file (QUEUE_DB if None), created if it does not exist
+            lease_seconds (float): duration of the leases
+            max_attempts (int): attempts of a task before it is marked as failed
+            retry_delay (float): seconds before a failed task is retried, times its attempts
+        """
+        self.path = QUEUE_DB if path is None else path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        # sqlite connections cannot be shared between threads
+        self.local = threading.local()
+        self.create_table()
+
+    @property
+    def connection(self):
+        if getattr(self.local, "connection", None) is None:
+            # transactions are started explicitly (BEGIN IMMEDIATE) to lease atomically
+            connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            connection.row_factory = sqlite3.Row
+            # rollback journal rather than WAL (see the module docstring); resets a queue created in WAL mode
+            connection.execute("PRAGMA journal_mode=DELETE")
+            self.local.connection = connection
+        return self.local.connection
+
+    def close(self):
+        """Closes the connection of the current thread (a new one is opened on next use)."""
+        connection = getattr(self.local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
+
+    def transaction(self):
+        """Write transaction: taking the write lock first, so that two workers never lease the same task."""
+        return Transaction(self.connection)
+
+    def create_table(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with self.transaction() as c:
+            c.execute("""
+                CREATE TABLE IF NOT EXISTS tasks (
+                    game_id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    worker TEXT, lease_expires REAL, available_at REAL NOT NULL DEFAULT 0,
+                    result TEXT, error TEXT, updated REAL
+                )
+            """)
+            c.execute("CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, available_at)")
+
+    def enqueue(self, game_ids: list):
+        """
+        Adds tasks for the games. Games that are already queued (in any status) are not added again.
+        Returns:
+            n: number of added tasks
+        """
+        now = time.time()
+        with self.transaction() as c:
+            before = c.execute("SELECT COUNT(*) FROM tasks").fetchone()[0]
+            c.executemany(
+                "INSERT OR IGNORE INTO tasks (game_id, updated) VALUES (?, ?)",
+                [(str(game_id), now) for game_id in game_ids]
+            )
+            return c.execute("SELECT COUNT(*) FROM tasks").fetchone()[0] - before
+
+    def lease(self, worker: str, n=1):
+        """
+        Leases up to n tasks to a worker: pending tasks that are available, and leased tasks whose
+        lease expired (their worker probably died). An expired task that was already leased
+        max_attempts times is marked as failed instead, so that a game that kills its workers
+        (e.g. out of memory) is not retried forever.
+        Returns:
+            game_ids: list of the leased game IDs
+        """
+        now = time.time()
+        with self.transaction() as c:
+            c.execute(
+                "UPDATE tasks SET status = 'failed', error = ?, lease_expires = NULL, updated = ? "
+                "WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?",
+                ("lease expired (worker died?) after {} attempts".format(self.max_attempts), now, now, self.max_attempts)
+            )
+            rows = c.execute(
+                "SELECT game_id FROM tasks WHERE (status = 'pending' AND available_at <= ?) "
+                "OR (status = 'leased' AND lease_expires < ?) ORDER BY game_id LIMIT ?",
+                (now, now, n)
+            ).fetchall()
+            game_ids = [row["game_id"] for row in rows]
+            c.executemany(
+                "UPDATE tasks SET status = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1, "
+                "updated = ? WHERE game_id = ?",
+                [(worker, now + self.lease_seconds, now, game_id) for game_id in game_ids]
+            )
+        return game_ids
+
+    def extend(self, game_id: str, worker: str):
+        """Extends the lease of a task still held by the worker. Returns False if it lost it."""
+        now = time.time()
+        with self.transaction() as c:
+            updated = c.execute(
+                "UPDATE tasks SET lease_expires = ?, updated = ? WHERE game_id = ? AND status = 'leased' AND worker = ?",
+                (now + self.lease_seconds, now, str(game_id), worker)
+            ).rowcount
+        return updated == 1
+
+    def complete(self, game_id: str, worker: str, result=None):
+        """
+        Marks a task leased by the worker as done, with an optional json serializable result.
+        Returns:
+            bool: False if the worker no longer held the lease (the task was leased again)
+        """
+        with self.transaction() as c:
+            updated = c.execute(
+                "UPDATE tasks SET status = 'done', result = ?, error = NULL, lease_expires = NULL, updated = ? "
+                "WHERE game_id = ? AND status = 'leased' AND worker = ?",
+                (json.dumps(result), time.time(), str(game_id), worker)
+            ).rowcount
+        return updated == 1
+
+    def fail(self, game_id: str, worker: str, error):
+        """
+        Records a failed attempt: the task is retried later, or marked as failed after
+        max_attempts attempts.
+        Returns:
+            status: new status of the task ('pending' or 'failed'), None if the worker lost the lease
+        """
+        now = time.time()
+        with self.transaction() as c:
+            row = c.execute(
+                "SELECT attempts FROM tasks WHERE game_id = ? AND status = 'leased' AND worker = ?",
+                (str(game_id), worker)
+            ).fetchone()
+            if row is None:
+                return None
+            status = "failed" if row["attempts"] >= self.max_attempts else "pending"
+            c.execute(
+                "UPDATE tasks SET status = ?, error = ?, lease_expires = NULL, available_at = ?, updated = ? "
+                "WHERE game_id = ?",
+                (status, str(error), now + self.retry_delay * row["attempts"], now, str(game_id))
+            )
+        return status
+
+    def retry_failed(self):
+        """Puts the failed tasks back in the queue, with a new budget of attempts."""
+        with self.transaction() as c:
+            return c.execute(
+                "UPDATE tasks SET status = 'pending', attempts = 0, available_at = 0, updated = ? WHERE status = 'failed'",
+                (time.time(),)
+            ).rowcount
+
+    def status(self):
+        """
+        Returns:
+            counts: dict of status -> number of tasks, and 'expired' (leased tasks whose lease expired)
+        """
+        rows = self.connection.execute("SELECT status, COUNT(*) AS n FROM tasks GROUP BY status").fetchall()
+        counts = {row["status"]: row["n"] for row in rows}
+        counts["expired"] = self.connection.execute(
+            "SELECT COUNT(*) FROM tasks WHERE status = 'leased' AND lease_expires < ?", (time.time(),)
+        ).fetchone()[0]
+        return counts
+
+    def remaining(self):
+        """Number of tasks that are not done nor failed."""
+        return self.connection.execute(
+            "SELECT COUNT(*) FROM tasks WHERE status IN ('pending', 'leased')"
+        ).fetchone()[0]
+
+    def failures(self):
+        """Failed tasks, with their last error."""
+        rows = self.connection.execute("SELECT game_id, attempts, error FROM tasks WHERE status = 'failed'").fetchall()
+        return [dict(row) for row in rows]
+
+
+class Transaction:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.execute("BEGIN IMMEDIATE")
+        return self.connection
+
+    def __exit__(self, exc_type, exc, tb):
+        self.connection.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False
+
+
+def season_game_ids(years: list, use_index=True):
+    """
+    Game IDs of the regular season and playoff games of the seasons, from the season index (see
+    season_index), or every candidate ID of FetchData.game_ids_regular/game_ids_playoff.
+    """
+    from ift6758.data import season_index
+    from ift6758.data.fetch_data import FetchData
+
+    game_ids = []
+    for year in years:
+        if use_index:
+            game_ids += season_index.existing_game_ids(year, 'R') + season_index.existing_game_ids(year, 'P')
+        else:
+            game_ids += FetchData().game_ids_regular(year) + FetchData().game_ids_playoff(year)
+    return game_ids
+
+
+def process_game(game_id: str, featurize=True):
+    """
+    Task of a game: downloads its feed (get_play_by_play, to NHL_DATA_DIR) and computes its
+    features (to the feature cache, NHL_FEATURES_DIR) if the game is finished.
+    Returns:
+        result: dict with the number of plays and shots, or {'missing': True} for unknown games
+    """
+    from ift6758.data.feature_cache import FeatureCache
+    from ift6758.data.fetch_data import FetchData
+
+    data = FetchData().get_play_by_play(game_id)
+    if "liveData" not in data:
+        return {'missing': True}
+    result = {'plays': len(data["liveData"]["plays"]["allPlays"])}
+    if featurize:
+        X = FeatureCache().game_features(game_id)
+        result['shots'] = 0 if X is None else len(X)
+    return result
+
+
+@contextmanager
+def lease_heartbeat(queue, game_id: str, worker: str):
+    """
+    Renews the lease of a task in a background thread while it is processed, every third of the
+    lease duration, so that a long task is not leased again to another worker.
+    """
+    stop = threading.Event()
+
+    def renew():
+        try:
+            while not stop.wait(queue.lease_seconds / 3):
+                if not queue.extend(game_id, worker):
+                    return
+        finally:
+            queue.close()
+
+    thread = threading.Thread(target=renew, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def run_worker(queue=None, worker=None, featurize=True, batch=1, wait=False, poll_interval=1.0):
+    """
+    Leases and processes tasks until the queue is empty (or forever if wait is True).
+    Args:
+        queue (WorkQueue): WorkQueue() if None
+        worker (str): worker ID (host:pid:random if None)
+        featurize (bool): also compute the features of the games
+        batch (int): tasks leased at once
+        wait (bool): wait for new tasks when the queue is empty, instead of returning
+        poll_interval (float): seconds between two leases when there is no available task
+    Returns:
+        counts: dict with the numbers of tasks done and failed by this worker, and of the leases
+            it lost (expired, and the task was leased again by another worker)
+    """
+    queue = WorkQueue() if queue is None else queue
+    worker = worker or "{}:{}:{}".format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:6])
+    counts = {'done': 0, 'failed': 0, 'lost': 0}
+    while True:
+        game_ids = queue.lease(worker, batch)
+        if not game_ids:
+            # tasks leased by other workers or waiting for a retry may come back
+            if not wait and queue.remaining() == 0:
+                return counts
+            time.sleep(poll_interval)
+            continue
+        for game_id in game_ids:
+            # the later tasks of a batch waited for the previous ones: renew their lease before
+            # starting, and skip them if it expired and another worker took them
+            if not queue.extend(game_id, worker):
+                counts['lost'] += 1
+                continue
+            try:
+                with lease_heartbeat(queue, game_id, worker):
+                    result = process_game(game_id, featurize)
+            except Exception as e:
+                held = queue.fail(game_id, worker, repr(e)) is not None
+                counts['failed' if held else 'lost'] += 1
+            else:
+                held = queue.complete(game_id, worker, result)
+                counts['done' if held else 'lost'] += 1
+
+
+def worker_process(path, featurize, batch, wait):
+    return run_worker(WorkQueue(path), featurize=featurize, batch=batch, wait=wait)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Work queue of the games to download and featurize.")
+    parser.add_argument("command", choices=["enqueue", "work", "status", "retry"])
+    parser.add_argument("years", type=int, nargs="*", help="enqueue: first years of the seasons")
+    parser.add_argument("--db", default=None, help="path of the queue database (NHL_WORK_QUEUE)")
+    parser.add_argument("--no-index", action="store_true", help="enqueue every candidate game ID")
+    parser.add_argument("--processes", type=int, default=1, help="work: worker processes on this node")
+    parser.add_argument("--batch", type=int, default=1, help="work: tasks leased at once")
+    parser.add_argument("--no-features", action="store_true", help="work: only download the feeds")
+    parser.add_argument("--wait", action="store_true", help="work: keep waiting for new tasks")
+    args = parser.parse_args()
+
+    path = QUEUE_DB if args.db is None else args.db
+    if args.command == "work":
+        # the queue is opened by the workers only: a SQLite connection must not be inherited by a fork
+        with multiprocessing.Pool(args.processes) as pool:
+            counts = pool.starmap(worker_process, [(path, not args.no_features, args.batch, args.wait)] * args.processes)
+        print(counts)
+    queue = WorkQueue(path)
+    if args.command == "enqueue":
+        print(queue.enqueue(season_game_ids(args.years, use_index=not args.no_index)), "tasks added")
+    elif args.command == "retry":
+        print(queue.retry_failed(), "failed tasks requeued")
+    print(json.dumps(queue.status()))
@@ -3,26 +3,67 @@ If you are in the same directory as this file (app.py), you can run run the app
     
     $ gunicorn --bind 0.0.0.0:5000 app:app --timeout 600
 
+The ift6758 package must be installed (pip install -e ift6758) for the feature schemas.
+
 """
+import itertools
 import os
 from pathlib import Path
 import logging
 from flask import Flask, jsonify, request, abort
 from flask_caching import Cache
 import xgboost
+import numpy as np
 import pandas as pd
-from comet_ml import API
+
+from ift6758.data.feature_cache import SharedGameFeatures
+from ift6758.data.fetch_data import FetchData
+from ift6758.data.feature_schema import MODEL_FILES, get_columns, get_schema, validate_columns
+from ift6758.data.fetcher import FetchError
+
+from compiled_model import compile_model
+from profiling import init_profiling
 
 
 LOG_FILE = os.environ.get("FLASK_LOG", "flask.log")
+MODELS_DIR = os.environ.get("MODELS_DIR", "models")
+
+# Matching the name of the model to the name of the downloaded file (shared with the load test)
+matching_model = MODEL_FILES
+
+# Inference backend of each model: 'xgboost' (booster.inplace_predict, the default) or 'compiled'
+# (trees compiled to NumPy arrays, faster for the few rows of live games, see compiled_model.py).
+# Set with MODEL_BACKENDS=<model>=<backend>,... or the backend field of /download_registry_model.
+BACKENDS = ('xgboost', 'compiled')
+model_backends = dict(
+    item.split('=', 1) for item in os.environ.get("MODEL_BACKENDS", "").split(',') if '=' in item
+)
+
+# Largest difference with predict_proba accepted when a model is read (see check_parity)
+PARITY_ATOL = 1e-5
 
-# Matching the name of the model to the name of the downloaded file
-matching_model = {
-    'xgboost-best-select-features': 'XGBoost_best_select_features.pkl',
-    'xgboost-best-all-features': 'XGBoost_best_all_features.pkl',
-    'xgboost-base-all-features': 'XGBoost_base_all_features.pkl'
+# Model loaded when the process starts
+default_model = {
+    'workspace': 'ift-6758-projet-quipe-13',
+    'model': 'xgboost-best-all-features',
+    'version': '1.0.0'
 }
 
+# Model currently used for the predictions. It is kept in memory here rather than in the flask
+# cache: SimpleCache pickles its values, which would deserialize the whole model on every request.
+current_model = {}
+
+# Other models of the models folder used by /predict_game, loaded on first use
+loaded_models = {}
+
+# Number of each model read, so that the predictions of a model cached by the games are not reused
+# once another version or backend of the model is loaded under the same name
+model_load_ids = itertools.count()
+
+# Features of the games requested to /predict_game, shared by all the requests (one fetch and one
+# featurization per game, then again every NHL_LIVE_TTL seconds for live games)
+game_features = SharedGameFeatures()
+
 # Flask Cache Configs
 config = {
     "DEBUG": True,          # some Flask specific configs
@@ -34,6 +75,8 @@ config = {
 app = Flask(__name__)
 app.config.from_mapping(config)
 cache = Cache(app=app)
+# Opt-in request profiling (SERVING_PROFILING=1), see profiling.py
+init_profiling(app)
 
 def get_api_key():
     """Retrieves the CometML API key from the current environment.
@@ -44,39 +87,129 @@ def get_api_key():
     return os.environ.get("COMET_API_KEY", None)
 
 
-@app.before_first_request
-def before_first_request():
+def get_api():
+    """Returns the CometML API object, creating it on first use.
+
+    comet_ml is only imported here, so that the server can start and serve a model already
+    on disk without paying for the import (or needing a network connection).
+
+    Returns:
+        comet_ml.API: the API object
     """
-    Hook to handle any initialization before the first request (e.g. load model,
-    setup logging handler, etc.)
+    api = cache.get('api')
+    if api is None:
+        from comet_ml import API
+        api = API(get_api_key())
+        cache.set('api', api)
+    return api
+
+
+def load_model(workspace: str, model: str, version: str):
+    """Loads a model from the models folder, downloading it from the CometML registry first
+    only if it is not already on disk. The loaded model becomes the current model.
+
+    Args:
+        workspace (str): The Comet ML workspace
+        model (str): The model name, one of the keys of matching_model
+        version (str): The model version
+
+    Returns:
+        bool: True if the model was downloaded, False if it was loaded from the local folder
+    """
+    model_path = os.path.join(MODELS_DIR, matching_model[model])
+    downloaded = False
+    if not Path(model_path).exists():
+        get_api().download_registry_model(workspace, model, version, output_path=MODELS_DIR)
+        downloaded = True
+    current_model.update(read_model(model))
+    loaded_models[model] = dict(current_model)
+    return downloaded
+
+
+def read_model(model: str):
+    """Reads a model of the models folder, and compiles it if its backend is 'compiled' (see
+    model_backends). A model that cannot be compiled, or whose compiled trees do not match
+    predict_proba, is served by xgboost.
+
+    Returns:
+        dict: with keys name, classifier (XGBClassifier), booster, backend, predictor (the
+            booster or the compiled model, used by predict_matrix) and load_id (see model_load_ids)
+    """
+    xgb = xgboost.XGBClassifier()
+    xgb.load_model(os.path.join(MODELS_DIR, matching_model[model]))
+    booster = xgb.get_booster()
+    entry = {'name': model, 'classifier': xgb, 'booster': booster, 'backend': 'xgboost', 'predictor': booster,
+             'load_id': next(model_load_ids)}
+    if model_backends.get(model, 'xgboost') == 'compiled':
+        try:
+            entry['predictor'] = compile_model(xgb)
+            entry['backend'] = 'compiled'
+        except Exception as e:
+            # e.g. a model file written by another xgboost version than the one supported
+            app.logger.error(f"Could not compile model {model}, served by xgboost: {e!r}")
+    diff = check_parity(entry)
+    if diff > PARITY_ATOL:
+        app.logger.error(f"Predictions of model {model} differ from predict_proba by up to {diff:.2e}")
+    return entry
+
+
+def check_parity(entry: dict, n_rows=200, seed=0):
+    """Largest absolute difference between predict_matrix and XGBClassifier.predict_proba on
+    random rows (with missing values), for a model read by read_model.
+    """
+    rng = np.random.default_rng(seed)
+    booster = entry['booster']
+    X = rng.uniform(-200, 200, size=(n_rows, booster.num_features())).astype(np.float32)
+    X[rng.random(X.shape) < 0.05] = np.nan
+    X_df = pd.DataFrame(X, columns=booster.feature_names) if booster.feature_names else X
+    expected = entry['classifier'].predict_proba(X_df)[:, 1]
+    return float(np.abs(predict_matrix(X, entry['predictor']) - expected).max())
+
+
+def iteration_range(booster):
+    """Trees used by predict_proba: up to the best iteration of an early stopped model, all otherwise."""
+    best_iteration = booster.attr("best_iteration")
+    return (0, 0) if best_iteration is None else (0, int(best_iteration) + 1)
+
+
+def get_model(model: str):
+    """Returns a model by name: the current model, or a model already in the models folder
+    (it is not downloaded, see /download_registry_model).
+
+    Raises:
+        ValueError: unknown model, or model not downloaded yet
+    """
+    if model == current_model.get('name'):
+        return current_model
+    if model not in loaded_models:
+        if model not in matching_model:
+            raise ValueError(f"Unknown model {model}, available models are {list(matching_model)}")
+        if not Path(os.path.join(MODELS_DIR, matching_model[model])).exists():
+            raise ValueError(f"Model {model} is not downloaded, see /download_registry_model")
+        loaded_models[model] = read_model(model)
+    return loaded_models[model]
+
+
+def init_app():
+    """
+    Initialization done once when the process starts (setup logging handler, load the default
+    model), so that the first request does not pay for it.
     """
     # Basic logging configuration
     format = "%(asctime)s;%(levelname)s;%(message)s"
     logging.basicConfig(filename=LOG_FILE, level=logging.INFO, format=format)
-    app.logger.info("Before first request - Start")
+    app.logger.info("App initialization - Start")
 
-    # Load default model before handling the very first request
-    default_model = {
-        'workspace': 'ift-6758-projet-quipe-13',
-        'model': 'xgboost-best-all-features',
-        'version': '1.0.0'
-    }
     try:
-        # Try to load the model
-        api = API(get_api_key())
-        cache.set('api', api)
-        default_model['filename'] = matching_model[default_model['model']]
-        model_path = 'models/' + default_model['filename']
-        api.download_registry_model(default_model['workspace'], default_model['model'], default_model['version'], output_path="models/")
-        xgb = xgboost.XGBClassifier()
-        xgb.load_model(model_path)
-        cache.set('model', xgb)
-        app.logger.info(f"Default model properly loaded: {default_model}.")
+        # Try to load the default model, from disk when available
+        downloaded = load_model(default_model['workspace'], default_model['model'], default_model['version'])
+        source = "CometML API" if downloaded else "local folder"
+        app.logger.info(f"Default model properly loaded from {source}: {default_model}.")
     except Exception as e:
         # If an error occurs, catch it and shows it in the logs.
         app.logger.info("Error while trying to load the default model.")
         app.logger.error(e)
-    app.logger.info("Before first request - End")
+    app.logger.info("App initialization - End")
 
 
 @app.route("/hello")
@@ -110,7 +243,8 @@ def download_registry_model():
         {
             workspace: (required),
             model: (required),
-            version: (required)
+            version: (required),
+            backend: (optional) 'xgboost' or 'compiled', see model_backends
         }
     
     """
@@ -118,56 +252,205 @@ def download_registry_model():
     app.logger.info("Accessed page /download_registry_model")
     app.logger.info(f'Comet ML API parameters are the following: {json}')
     
-    json['filename'] = matching_model[json['model']]
-
-    model_path = 'models/' + json['filename']
-    
-    if Path(model_path).exists():
-        # Load the model from local files if it exists.
-        xgb = xgboost.XGBClassifier()
-        xgb.load_model(model_path)
-        cache.set('model', xgb)
-        app.logger.info("Model locally updated (without download) from: " + model_path)
-        response = 'Updated from local folder: ' + model_path
-    else:
-        try:
-            # Else, try downloading the model from cometML and then loading it.
-            api = cache.get('api')
-            api.download_registry_model(json['workspace'], json['model'], json['version'], output_path="models/")
-            xgb = xgboost.XGBClassifier()
-            xgb.load_model(model_path)
-            cache.set('model', xgb)
+    try:
+        # Load the model from local files if it exists, else download it from cometML first.
+        model_path = os.path.join(MODELS_DIR, matching_model[json['model']])
+        if 'backend' in json:
+            if json['backend'] not in BACKENDS:
+                raise ValueError(f"Unknown backend {json['backend']}, valid backends are {list(BACKENDS)}")
+            model_backends[json['model']] = json['backend']
+        if load_model(json['workspace'], json['model'], json['version']):
             app.logger.info("Model successfully loaded from CometML API")
             app.logger.info("Model downloaded to: " + model_path)
             response = 'Updated model from CometML api and downloaded locally.'
-        except Exception as e:
-            # Catch the exception
-            app.logger.error(e)
-            response = 'Unexpected error while downloading the model: ' + str(e)
+        else:
+            app.logger.info("Model locally updated (without download) from: " + model_path)
+            response = 'Updated from local folder: ' + model_path
+        app.logger.info(f"Model served by the {current_model['backend']} backend")
+    except Exception as e:
+        # Catch the exception
+        app.logger.error(e)
+        response = 'Unexpected error while downloading the model: ' + str(e)
+        app.logger.info(response)
+        return jsonify(response), 500
             
     app.logger.info(response)
     return jsonify(response)  # response must be json serializable!
 
 
+@app.route("/features", methods=["GET"])
+def features():
+    """
+    Handles GET requests made to http://IP_ADDRESS:PORT/features?model=<model name>
+
+    Returns the feature schema (ordered columns and dtypes) of the given model, or of the
+    current model if no model is given.
+    """
+    app.logger.info("Accessed page /features")
+    model_name = request.args.get('model', current_model.get('name'))
+    try:
+        response = get_schema(model_name)
+    except ValueError as e:
+        return jsonify(str(e)), 404
+    return jsonify(response)
+
+
 @app.route("/predict", methods=["POST"])
 def predict():
     """
     Handles POST requests made to http://IP_ADDRESS:PORT/predict
 
+    Expects a json of the form {"features": [...], "values": [[...], ...]}, one row of features
+    per shot. "features" is optional; when given, it must match the schema of the current model
+    (see /features), and is checked before running the model.
+
+    By default, the rows are converted to a float32 NumPy matrix and scored with the booster's
+    in-place prediction, which skips the DataFrame construction and the sklearn wrapper
+    validation (or with the compiled trees of the model, if its backend is 'compiled', see
+    model_backends). Add ?debug=true to the url to go through pd.json_normalize and
+    XGBClassifier.predict_proba instead.
+
     Returns predictions
     """
     app.logger.info("Accessed page /predict")
     app.logger.info("Start of prediction request.")
     r = request.get_json()
-    df = pd.json_normalize(r, list(r.keys())[0])
-    app.logger.debug('Input DataFrame shape:' + str(df.shape))
     try:
-        model = cache.get('model')
-        preds = model.predict_proba(df)[:, 1]
+        if 'features' in r:
+            validate_columns(current_model['name'], r['features'])
+        if request.args.get('debug', 'false').lower() == 'true':
+            preds = predict_dataframe(r['values'])
+        else:
+            preds = predict_matrix(r['values'])
         app.logger.debug('Output prediction DataFrame shape:' + str(preds.shape))
         response = preds.tolist()
     except Exception as e:
         app.logger.error(f"The following error occured during the prediction: {e}")
         # response = ['error, check logs.'] * df.shape[0]
-        response = str(e)
+        return jsonify(str(e)), 400
     return jsonify(response)  # response must be json serializable!
+
+
+@app.route("/predict_game", methods=["GET"])
+def predict_game():
+    """
+    Handles GET requests made to
+    http://IP_ADDRESS:PORT/predict_game?game_id=<game ID>&model=<model name>&since_eventIdx=<eventIdx>
+
+    Fetches, featurizes and scores the shots of a game on the server. The features and the
+    predictions of a game are shared by all the requests (see SharedGameFeatures), so that N
+    viewers of a game cost one fetch and one featurization. model defaults to the current model,
+    and must be in the models folder otherwise.
+
+    Returns a json of the form
+        {
+            game_id, model, final (bool, game ended),
+            shots: [{eventIdx, team, period, periodTimeSec, shooter, isGoal, probability}, ...]
+                only the shots after since_eventIdx if given,
+            xG: {team: sum of the probabilities of all the shots of the game},
+            goals: {team: score of the team}, from the linescore (see FetchData.get_game_info),
+                empty if it is not available,
+            scored_goals: {team: number of goals among the scored shots} (the goals whose
+                features are incomplete are not scored)
+        }
+    """
+    app.logger.info("Accessed page /predict_game")
+    game_id = request.args.get('game_id')
+    model_name = request.args.get('model', current_model.get('name'))
+    since = request.args.get('since_eventIdx')
+    if game_id is None:
+        return jsonify("game_id is required"), 400
+    if since is not None:
+        try:
+            since = int(since)
+        except ValueError:
+            return jsonify(f"since_eventIdx must be an integer, got {since}"), 400
+    try:
+        model = get_model(model_name)
+    except ValueError as e:
+        return jsonify(str(e)), 404
+
+    try:
+        entry = game_features.get(game_id)
+    except ValueError as e:
+        return jsonify(str(e)), 400
+    except FetchError as e:
+        app.logger.error(f"Could not fetch game {game_id}: {e}")
+        return jsonify(f"Could not fetch game {game_id}: {e}"), 502
+    if entry is None:
+        return jsonify(f"No play found for game {game_id}"), 404
+
+    proba = entry.predict(model_name, lambda X: predict_matrix(X.values, model['predictor']), model['load_id'])
+    X = entry.X
+    new = np.ones(len(X), dtype=bool) if since is None else (X['eventIdx'] > since).values
+    shots = X[new]
+    xg = pd.Series(proba, index=X.index).groupby(X['team']).sum()
+    scored_goals = X.groupby('team')['isGoal'].sum()
+    try:
+        info = FetchData().get_game_info(game_id)
+        goals = {info['away']: info['away_goals'], info['home']: info['home_goals']}
+        if None in goals.values():
+            goals = {}
+    except (FetchError, KeyError, TypeError) as e:
+        app.logger.error(f"Could not get the score of game {game_id}: {e}")
+        goals = {}
+    response = {
+        'game_id': game_id,
+        'model': model_name,
+        'final': entry.final,
+        'shots': [
+            {'eventIdx': idx, 'team': team, 'period': period, 'periodTimeSec': time,
+             'shooter': shooter, 'isGoal': goal, 'probability': p}
+            for idx, team, period, time, shooter, goal, p in zip(
+                shots['eventIdx'].tolist(), shots['team'].tolist(), shots['period'].tolist(),
+                shots['periodTimeSec'].tolist(), shots['shooter'].astype(object).where(shots['shooter'].notna(), None).tolist(),
+                shots['isGoal'].tolist(), proba[new].tolist())
+        ],
+        'xG': {team: float(v) for team, v in xg.items()},
+        'goals': {team: int(v) for team, v in goals.items()},
+        'scored_goals': {team: int(v) for team, v in scored_goals.items()},
+    }
+    app.logger.info(f"Game {game_id}: {len(shots)} shots scored with {model_name}")
+    return jsonify(response)
+
+
+def predict_matrix(values, predictor=None):
+    """Scores the rows with the predictor of the current model (its booster, or its compiled
+    trees, see read_model), without building a DataFrame.
+
+    Args:
+        values (list): list of rows of features, in the column order the model was trained on
+        predictor: booster or compiled model (predictor of the current model if None)
+
+    Returns:
+        np.ndarray: probability of a goal for each row
+    """
+    predictor = current_model['predictor'] if predictor is None else predictor
+    X = np.ascontiguousarray(values, dtype=np.float32)
+    if X.ndim == 2 and X.shape[0] == 0:
+        return np.empty(0, dtype=np.float32)
+    if X.ndim != 2 or X.shape[1] != predictor.num_features():
+        raise ValueError(f"Expected rows of {predictor.num_features()} features, got an input of shape {X.shape}")
+    app.logger.debug('Input matrix shape:' + str(X.shape))
+    if isinstance(predictor, xgboost.Booster):
+        # same trees as predict_proba (inplace_predict uses all of them by default)
+        return predictor.inplace_predict(X, iteration_range=iteration_range(predictor))
+    return predictor.inplace_predict(X)
+
+
+def predict_dataframe(values):
+    """Scores the rows through a DataFrame and XGBClassifier.predict_proba (debugging path).
+
+    Args:
+        values (list): list of rows of features, in the order of the schema of the current model
+
+    Returns:
+        np.ndarray: probability of a goal for each row
+    """
+    df = pd.DataFrame(values, columns=get_columns(current_model['name']))
+    app.logger.debug('Input DataFrame shape:' + str(df.shape))
+    return current_model['classifier'].predict_proba(df)[:, 1]
+
+
+# After the definitions: loading the model checks its predictions with predict_matrix
+init_app()
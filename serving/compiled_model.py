@@ -0,0 +1,229 @@
+"""
+Compiled backend of the XGBoost models: the trees of a booster are flattened into NumPy arrays of
+nodes, and evaluated for all the rows and all the trees at once, one level of the trees per step.
+The prediction of a few rows (live games) then costs a few NumPy operations, instead of the
+DMatrix and predictor setup of xgboost, which dominates the time of small predictions.
+
+    >>> compiled = compile_model(classifier)  # raises ValueError if it does not match predict_proba
+    >>> compiled.inplace_predict(X)           # same interface as the booster, for predict_matrix
+
+Large batches (e.g. a whole season) are still scored by the booster, see MAX_BATCH_NODES.
+
+Only the gbtree models with a binary:logistic objective and numerical splits are supported, which
+covers the models of matching_model (see app.py).
+"""
+import json
+
+import numpy as np
+import pandas as pd
+
+
+# Objectives whose prediction is the sigmoid of the margin
+LOGISTIC_OBJECTIVES = {"binary:logistic", "reg:logistic"}
+
+# Rows evaluated at once, bounds the (rows, trees) arrays of node indices
+CHUNK_ROWS = 2048
+
+# Largest batch evaluated by the compiled trees, in rows x trees: above, the vectorized evaluation
+# is slower than the xgboost predictor, whose setup cost is then amortized
+MAX_BATCH_NODES = 10000
+
+# Deeper trees would make the complete trees too large (2 ** depth leaves per tree)
+MAX_DEPTH = 12
+
+
+class CompiledBooster:
+    def __init__(self, booster):
+        """
+        Flattens the trees of a booster into complete binary trees of the same depth (a leaf above
+        the last level is copied to all the leaves below it), so that the children of node i are
+        2i + 1 and 2i + 2, and every row takes the same number of steps in every tree. The trees
+        used are the same as predict_proba's (up to the best iteration of an early stopped model).
+        Args:
+            booster (xgboost.Booster): booster of a binary classifier
+        Raises:
+            ValueError: booster, objective or splits not supported
+        """
+        self.booster = booster
+        learner = json.loads(booster.save_raw("json"))["learner"]
+        objective = learner["objective"]["name"]
+        if objective not in LOGISTIC_OBJECTIVES:
+            raise ValueError(f"Objective {objective} not supported by the compiled backend")
+        if learner["gradient_booster"]["name"] != "gbtree":
+            raise ValueError(f"Booster {learner['gradient_booster']['name']} not supported by the compiled backend")
+        model = learner["gradient_booster"]["model"]
+        trees = model["trees"]
+        best_iteration = learner.get("attributes", {}).get("best_iteration")
+        # iterations used by the booster for the large batches, (0, 0) for all of them
+        self.iteration_range = (0, 0)
+        if best_iteration is not None:
+            self.iteration_range = (0, int(best_iteration) + 1)
+            trees = trees[:iteration_end(learner, int(best_iteration) + 1)]
+        if any(any(tree["split_type"]) for tree in trees):
+            raise ValueError("Categorical splits are not supported by the compiled backend")
+
+        params = learner["learner_model_param"]
+        # "[5E-1]" from xgboost 2, "5E-1" before
+        base_score = float(params["base_score"].strip("[]"))
+        self.base_margin = np.log(base_score / (1 - base_score))
+        self.n_features = int(params["num_feature"])
+        self.feature_names = learner.get("feature_names") or None
+
+        self.n_trees = len(trees)
+        self.depth = max([tree_depth(tree) for tree in trees], default=0)
+        if self.depth > MAX_DEPTH:
+            raise ValueError(f"Trees of depth {self.depth} are too deep for the compiled backend (max {MAX_DEPTH})")
+        n_splits, n_leaves = 2 ** self.depth - 1, 2 ** self.depth
+        # one row per tree, flattened after filling
+        self.feature = np.zeros((self.n_trees, n_splits), dtype=np.intp)
+        self.threshold = np.zeros((self.n_trees, n_splits), dtype=np.float32)
+        self.default_right = np.zeros((self.n_trees, n_splits), dtype=bool)
+        self.leaf_value = np.zeros((self.n_trees, n_leaves), dtype=np.float32)
+        for i, tree in enumerate(trees):
+            self.fill(i, tree)
+        self.feature = self.feature.ravel()
+        self.threshold = self.threshold.ravel()
+        self.default_right = self.default_right.ravel()
+        self.leaf_value = self.leaf_value.ravel()
+        # first split and first leaf of each tree in the flat arrays
+        self.split_offsets = np.arange(self.n_trees, dtype=np.intp) * n_splits
+        self.leaf_offsets = np.arange(self.n_trees, dtype=np.intp) * n_leaves
+
+    def fill(self, i: int, tree: dict):
+        """Copies the nodes of a tree (xgboost JSON) to row i of the complete tree arrays."""
+        left, right = tree["left_children"], tree["right_children"]
+        stack = [(0, 0, 0)]  # node of the tree, position in the complete tree, level
+        while stack:
+            node, position, level = stack.pop()
+            if left[node] == -1:
+                # positions of the leaves below, on the last level
+                width = 2 ** (self.depth - level)
+                first = (position + 1) * width - 1 - (2 ** self.depth - 1)
+                self.leaf_value[i, first:first + width] = tree["split_conditions"][node]
+                continue
+            self.feature[i, position] = tree["split_indices"][node]
+            self.threshold[i, position] = tree["split_conditions"][node]
+            self.default_right[i, position] = not tree["default_left"][node]
+            stack.append((left[node], 2 * position + 1, level + 1))
+            stack.append((right[node], 2 * position + 2, level + 1))
+
+    def num_features(self):
+        return self.n_features
+
+    def predict_margin(self, X: np.ndarray):
+        """Margin (log odds) of each row of a float32 matrix."""
+        n = X.shape[0]
+        margin = np.full(n, self.base_margin, dtype=np.float64)
+        for start in range(0, n, CHUNK_ROWS):
+            chunk = X[start:start + CHUNK_ROWS]
+            margin[start:start + len(chunk)] += self.leaf_values(chunk).sum(axis=1, dtype=np.float64)
+        return margin
+
+    def leaf_values(self, X: np.ndarray):
+        """Value of the leaf reached by each row in each tree, shape (rows, trees)."""
+        flat = X.ravel()
+        # position of the first feature of each row in flat
+        row_offsets = np.arange(X.shape[0], dtype=np.intp)[:, None] * X.shape[1]
+        has_missing = np.isnan(flat).any()
+        nodes = np.zeros((X.shape[0], self.n_trees), dtype=np.intp)
+        for _ in range(self.depth):
+            splits = self.split_offsets + nodes
+            x = flat[row_offsets + self.feature[splits]]
+            # x < threshold goes left, and NaN to the default child
+            go_right = x >= self.threshold[splits]
+            if has_missing:
+                go_right |= np.isnan(x) & self.default_right[splits]
+            nodes *= 2
+            nodes += 1
+            nodes += go_right
+        return self.leaf_value[self.leaf_offsets + nodes - (2 ** self.depth - 1)]
+
+    def predict(self, X: np.ndarray):
+        """Probability of the positive class of each row of a float32 matrix, with the compiled trees."""
+        margin = self.predict_margin(X)
+        return (1 / (1 + np.exp(-margin))).astype(np.float32)
+
+    def inplace_predict(self, X: np.ndarray):
+        """
+        Probability of the positive class of each row, as booster.inplace_predict: with the compiled
+        trees for small batches (up to MAX_BATCH_NODES), with the booster otherwise.
+        Args:
+            X: float32 matrix (rows, num_features())
+        """
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        if X.ndim != 2 or X.shape[1] != self.n_features:
+            raise ValueError(f"Expected rows of {self.n_features} features, got an input of shape {X.shape}")
+        if X.shape[0] * self.n_trees > MAX_BATCH_NODES:
+            return self.booster.inplace_predict(X, iteration_range=self.iteration_range)
+        return self.predict(X)
+
+
+def iteration_end(learner: dict, n_iterations: int):
+    """Number of trees of the first n_iterations boosting iterations of a model (xgboost JSON)."""
+    model = learner["gradient_booster"]["model"]
+    if "iteration_indptr" in model:
+        return model["iteration_indptr"][n_iterations]
+    # written from xgboost 2 only: before, every iteration has num_parallel_tree trees per class
+    params = model["gbtree_model_param"]
+    trees_per_iteration = int(params.get("num_parallel_tree", 1)) * max(int(learner["learner_model_param"].get("num_class", 0)), 1)
+    return n_iterations * trees_per_iteration
+
+
+def tree_depth(tree: dict):
+    """Number of splits on the longest path from the root of a tree (xgboost JSON) to a leaf."""
+    left, right = tree["left_children"], tree["right_children"]
+    max_depth = 0
+    stack = [(0, 0)]
+    while stack:
+        node, depth = stack.pop()
+        if left[node] == -1:
+            max_depth = max(max_depth, depth)
+        else:
+            stack += [(left[node], depth + 1), (right[node], depth + 1)]
+    return max_depth
+
+
+def probe_matrix(compiled: CompiledBooster, n_rows=2000, seed=0):
+    """
+    Rows that exercise both sides of the splits: each value is a split threshold of its feature,
+    or the float32 just below it, or a missing value.
+    """
+    rng = np.random.default_rng(seed)
+    X = np.full((n_rows, compiled.n_features), np.nan, dtype=np.float32)
+    for feature in range(compiled.n_features):
+        thresholds = np.unique(compiled.threshold[compiled.feature == feature])
+        if len(thresholds) == 0:
+            X[:, feature] = rng.normal(size=n_rows)
+            continue
+        values = np.concatenate([thresholds, np.nextafter(thresholds, np.float32(-np.inf))])
+        X[:, feature] = rng.choice(values, size=n_rows)
+    X[rng.random(X.shape) < 0.05] = np.nan
+    return X
+
+
+def check_parity(classifier, compiled: CompiledBooster, n_rows=2000, seed=0):
+    """
+    Largest absolute difference between the probabilities of the compiled booster and
+    classifier.predict_proba, on probe_matrix rows.
+    """
+    X = probe_matrix(compiled, n_rows, seed)
+    if compiled.feature_names is not None:
+        X_df = pd.DataFrame(X, columns=compiled.feature_names)
+    else:
+        X_df = X
+    expected = classifier.predict_proba(X_df)[:, 1]
+    return float(np.abs(compiled.predict(X) - expected).max())
+
+
+def compile_model(classifier, atol=1e-5):
+    """
+    Compiles the booster of an XGBClassifier, and checks that it gives the same probabilities as
+    classifier.predict_proba.
+    Raises:
+        ValueError: model not supported, or probabilities that differ by more than atol
+    """
+    compiled = CompiledBooster(classifier.get_booster())
+    diff = check_parity(classifier, compiled)
+    if diff > atol:
+        raise ValueError(f"Compiled model differs from predict_proba by up to {diff:.2e} (atol {atol:.0e})")
+    return compiled
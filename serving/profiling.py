@@ -0,0 +1,146 @@
+"""
+Opt-in profiling of individual requests of the serving app, with cProfile.
+
+Nothing is registered unless SERVING_PROFILING is set to 1 when the app starts, so the requests
+pay nothing when it is disabled. When enabled, a request is profiled if:
+    - it has the header X-Profile: 1, or the query parameter ?profile=true
+    - or it is sampled, with probability PROFILE_SAMPLE_RATE (0 by default)
+
+The profiles are saved in PROFILE_DIR, which keeps the last PROFILE_MAX_FILES profiles, and can
+be listed and downloaded with:
+    GET /admin/profiles                 list of the profiles, most recent first
+    GET /admin/profiles/<id>            the profile (pstats file, e.g. for snakeviz)
+    GET /admin/profiles/<id>?format=text   the top functions by cumulative time
+If PROFILE_ADMIN_TOKEN is set, these requests need the header X-Admin-Token: <token>.
+"""
+import cProfile
+import io
+import os
+import pstats
+import random
+import re
+import threading
+import time
+
+from flask import abort, g, jsonify, request, send_file
+
+
+ENABLED = os.environ.get("SERVING_PROFILING", "0") == "1"
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+PROFILE_MAX_FILES = int(os.environ.get("PROFILE_MAX_FILES", 50))
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", 0))
+PROFILE_ADMIN_TOKEN = os.environ.get("PROFILE_ADMIN_TOKEN")
+
+# <time in ns>_<endpoint>_<duration in µs>.prof
+PROFILE_NAME = re.compile(r"^(\d+)_([A-Za-z0-9_]+)_(\d+)\.prof$")
+
+lock = threading.Lock()
+
+
+def init_profiling(app):
+    """
+    Registers the profiling hooks and the admin endpoints on the app, if SERVING_PROFILING=1.
+    Returns:
+        bool: whether profiling is enabled
+    """
+    if not ENABLED:
+        return False
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    app.before_request(start_profile)
+    app.after_request(stop_profile)
+    app.teardown_request(discard_profile)
+    app.add_url_rule("/admin/profiles", "list_profiles", list_profiles)
+    app.add_url_rule("/admin/profiles/<profile_id>", "get_profile", get_profile)
+    app.logger.info(f"Request profiling enabled, profiles saved in {PROFILE_DIR}")
+    return True
+
+
+def profile_requested():
+    if request.path.startswith("/admin/"):
+        return False
+    return (
+        request.headers.get("X-Profile") == "1"
+        or request.args.get("profile", "false").lower() == "true"
+        or (PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE)
+    )
+
+
+def start_profile():
+    if not profile_requested():
+        return
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError:
+        # another request is being profiled (only one profiler at a time from python 3.12)
+        return
+    g.profile = profile
+    g.profile_start = time.perf_counter()
+
+
+def stop_profile(response):
+    profile = g.pop("profile", None)
+    if profile is None:
+        return response
+    profile.disable()
+    duration = time.perf_counter() - g.pop("profile_start")
+    name = "{}_{}_{}.prof".format(time.time_ns(), request.endpoint or "unknown", int(duration * 1e6))
+    profile.dump_stats(os.path.join(PROFILE_DIR, name))
+    prune()
+    response.headers["X-Profile-Id"] = name[:-len(".prof")]
+    return response
+
+
+def discard_profile(exception=None):
+    """Stops the profiler of a request that failed before after_request."""
+    profile = g.pop("profile", None)
+    if profile is not None:
+        profile.disable()
+
+
+def prune():
+    """Deletes the oldest profiles beyond PROFILE_MAX_FILES."""
+    with lock:
+        names = sorted(name for name in os.listdir(PROFILE_DIR) if PROFILE_NAME.match(name))
+        for name in names[:-PROFILE_MAX_FILES]:
+            try:
+                os.remove(os.path.join(PROFILE_DIR, name))
+            except FileNotFoundError:
+                pass
+
+
+def check_token():
+    if PROFILE_ADMIN_TOKEN is not None and request.headers.get("X-Admin-Token") != PROFILE_ADMIN_TOKEN:
+        abort(403)
+
+
+def list_profiles():
+    """Profiles on disk, most recent first."""
+    check_token()
+    profiles = []
+    for name in sorted(os.listdir(PROFILE_DIR), reverse=True):
+        match = PROFILE_NAME.match(name)
+        if match is None:
+            continue
+        profiles.append({
+            'id': name[:-len(".prof")],
+            'created': int(match.group(1)) / 1e9,
+            'endpoint': match.group(2),
+            'duration_ms': int(match.group(3)) / 1e3,
+            'size': os.path.getsize(os.path.join(PROFILE_DIR, name)),
+        })
+    return jsonify(profiles)
+
+
+def get_profile(profile_id):
+    """The pstats file of a profile, or its top functions with ?format=text."""
+    check_token()
+    name = profile_id + ".prof"
+    path = os.path.join(PROFILE_DIR, name)
+    if not PROFILE_NAME.match(name) or not os.path.exists(path):
+        abort(404)
+    if request.args.get("format") == "text":
+        out = io.StringIO()
+        pstats.Stats(path, stream=out).sort_stats("cumulative").print_stats(int(request.args.get("limit", 40)))
+        return out.getvalue(), 200, {"Content-Type": "text/plain; charset=utf-8"}
+    return send_file(os.path.abspath(path), mimetype="application/octet-stream", as_attachment=True, download_name=name)
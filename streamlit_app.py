@@ -8,9 +8,12 @@ import streamlit as st
 import pandas as pd
 import numpy as np
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from ift6758.client.serving_client import ServingClient
 from ift6758.client.game_client import GameClient
+from ift6758.data import pd_make_df
 
 # """
 # General template for your streamlit app. 
@@ -22,16 +25,46 @@ IP = os.environ.get("SERVING_IP", "0.0.0.0")
 PORT = os.environ.get("SERVING_PORT", 5000)
 base_url = f"http://{IP}:{PORT}"
 
+# Seconds during which the parsed feed of a live game is shared between sessions
+LIVE_FEED_TTL = 5
+
+
+#################### CACHED RESOURCES (shared by every session)
+
+@st.cache_resource
+def get_executor():
+    # Background threads fetching and scoring the games
+    return ThreadPoolExecutor(max_workers=4)
+
+
+@st.cache_data(show_spinner=False, max_entries=256)
+def load_final_game(gameId):
+    return pd_make_df.create_dataframe_from_game(gameId, use_cache=True)
+
+
+@st.cache_data(show_spinner=False, ttl=LIVE_FEED_TTL, max_entries=64)
+def load_live_game(gameId):
+    return pd_make_df.create_dataframe_from_game(gameId, use_cache=False)
+
+
+def load_game(gameId, use_cache=True):
+    """Parsed feed of a game, cached across sessions (briefly for live games)."""
+    return load_final_game(gameId) if use_cache else load_live_game(gameId)
+
 
 #################### STREAMLIT SESSION STATE OBJECTS
 
 if 'gameClient' not in st.session_state:
-    gameClient = GameClient()
+    gameClient = GameClient(loader=load_game)
     st.session_state['gameClient'] = gameClient
 
 if 'servingClient' not in st.session_state:
-    servingClient = ServingClient(ip=IP, port=PORT)
-    st.session_state['servingClient'] = servingClient
+    # One client per session: its model and features change with the model of the session
+    st.session_state['servingClient'] = ServingClient(ip=IP, port=PORT)
+
+if 'pending_update' not in st.session_state:
+    # (game ID, model, future) of the update running in the background, at most one per session
+    st.session_state.pending_update = None
 
 if 'model_downloaded' not in st.session_state:
      st.session_state['model_downloaded'] = False
@@ -42,8 +75,9 @@ if 'model' not in st.session_state:
 if 'model_selection_change' not in st.session_state:
     st.session_state['model_selection_change'] = False
 
-if 'stored_df' not in st.session_state: 
-    st.session_state.stored_df = None
+if 'stored_chunks' not in st.session_state:
+    # New rows of each ping, concatenated only for display
+    st.session_state.stored_chunks = []
 
 if 'pred_goals' not in st.session_state:
     st.session_state.pred_goals = [0,0]
@@ -57,6 +91,13 @@ if 'teams' not in st.session_state:
 if 'teams_full' not in st.session_state:
     st.session_state.teams_full = None
 
+if 'period_info' not in st.session_state:
+    st.session_state.period_info = None
+
+if 'live' not in st.session_state:
+    # A game was pinged and is refreshed automatically
+    st.session_state.live = False
+
 
 
 #################### FUNCTION DEFINITION
@@ -87,6 +128,129 @@ def calculate_game_goals(df: pd.DataFrame, pred: pd.DataFrame, teams_A_H: list):
     return pred_goals
 
 
+def fetch_update(gameClient: GameClient, servingClient: ServingClient, game_id: str, model: str):
+    """
+    Gets the new events of the game, their predictions and the game info.
+    Runs in a background thread, so it must not use streamlit.
+        Output:
+            update (dict), with the new rows ('df', None if no new events), the predicted goals
+            of the new rows, and the game info
+    """
+    update = {'df': None, 'game_id': game_id, 'model': model}
+    df_MODEL = gameClient.process_query(game_id, model_name=model)
+
+    # If there are new events: 
+    if df_MODEL is not None:
+        # Make predictions on events 
+        pred_MODEL = servingClient.predict(df_MODEL)
+
+        df = pd.DataFrame(df_MODEL, columns=servingClient.features)
+        df = df.reset_index(drop=True)
+        df['Model Output'] = pred_MODEL
+
+        # Calculate game actual goals and goal predictions 
+        real_goals, teams_A_H, teams_full = gameClient.get_scores()
+        update['df'] = df
+        update['pred_goals'] = calculate_game_goals(df_MODEL, pred_MODEL, teams_A_H)
+        update['real_goals'] = real_goals
+        update['teams'] = teams_A_H
+        update['teams_full'] = teams_full
+
+    if gameClient.gameId == game_id:
+        update['period_info'] = gameClient.get_period_info()
+    return update
+
+
+def start_update(game_id: str, model: str):
+    """
+    Returns the future of the session's update of the game, submitting fetch_update if none is
+    running. A single update runs at a time, so that the GameClient of the session is never
+    used by two threads: the update of another game or model is waited for and dropped first.
+    """
+    pending = st.session_state.pending_update
+    if pending is not None:
+        pending_game_id, pending_model, future = pending
+        if (pending_game_id, pending_model) == (game_id, model):
+            # started by a run that was interrupted, its events are applied by this run
+            return future
+        drop_pending_update()
+    future = get_executor().submit(
+        fetch_update, st.session_state.gameClient, st.session_state.servingClient, game_id, model
+    )
+    st.session_state.pending_update = (game_id, model, future)
+    return future
+
+
+def drop_pending_update():
+    """Waits for the running update of the session, if any, and ignores its result."""
+    pending = st.session_state.pending_update
+    if pending is not None:
+        pending[2].result()
+        st.session_state.pending_update = None
+
+
+def finish_update(future):
+    """
+    Waits for an update started by start_update and applies it to the session state, on the
+    script thread. The update stays pending until it is applied, so that a rerun interrupting
+    this run does not lose its events.
+    """
+    update = future.result()
+    apply_update(update)
+    st.session_state.pending_update = None
+    return update
+
+
+def apply_update(update: dict):
+    """Adds an update from fetch_update to the session state."""
+    if update['df'] is not None:
+        for i in range(len(update['teams'])):
+            st.session_state.pred_goals[i] += update['pred_goals'][i]
+            st.session_state.real_goals[i] = update['real_goals'][i]
+        st.session_state.teams = update['teams']
+        st.session_state.teams_full = update['teams_full']
+        st.session_state.stored_chunks.append(update['df'])
+    if 'period_info' in update:
+        st.session_state.period_info = update['period_info']
+
+
+def reset_game_state():
+    """Reinitialize session state objects of the current game"""
+    st.session_state.stored_chunks = []
+    st.session_state.real_goals = [0,0]
+    st.session_state.pred_goals = [0,0]
+    st.session_state.period_info = None
+    st.session_state.live = False
+
+
+def render_game_info(new_events=True):
+    """Game info and goal predictions, from the session state."""
+    # Always the same elements, so that re-rendering the placeholder leaves no stale element
+    st.write('' if new_events else ':red[No new events!]')
+    if st.session_state.teams_full is None:
+        return
+
+    # Getting Game info:
+    st.subheader(f"{st.session_state.teams_full[0]} VS {st.session_state.teams_full[1]}")
+
+    period, periodTimeRemaining = st.session_state.period_info
+    if st.session_state.gameClient.game_ended: 
+        st.write('**Game ended!**')
+        st.write(f'Game end at: **Period:** {period}  --  **Period time remaining:** {periodTimeRemaining}')  
+    else: 
+        st.write('**Game live!**')        
+        st.write(f'**Period:** {period}  --  **Period time remaining:** {periodTimeRemaining}')      
+
+    # Display game goal predictions and info:
+    col1, col2 = st.columns(2)
+    pred_goals_round = np.round(st.session_state.pred_goals, decimals=1)
+
+    delta1 = float(np.round(pred_goals_round[0] - st.session_state.real_goals[0], decimals=1))
+    delta2 = float(np.round(pred_goals_round[1] - st.session_state.real_goals[1], decimals=1))
+    col1.metric(label=f"**{st.session_state.teams[0]}** xG (actual)", value=f"{pred_goals_round[0]} ({st.session_state.real_goals[0]})", delta=delta1)
+    col2.metric(label=f"**{st.session_state.teams[1]}** xG (actual)", value=f"{pred_goals_round[1]} ({st.session_state.real_goals[1]})", delta=delta2)
+
+
 #################### STREAMLIT APP
 
 st.title("Hockey Visualization App")
@@ -111,13 +275,13 @@ with st.sidebar:
         st.session_state['model_downloaded'] = True 
         st.session_state['model'] = model
 
+        # the GameClient must not be updated in the background while the model changes
+        drop_pending_update()
         st.session_state.servingClient.download_registry_model(workspace, st.session_state.model, version)
         st.write(f'Got model:\n **{st.session_state.model}**!')
 
         # Reinitialize session state objects if model changes
-        st.session_state.stored_df = None 
-        st.session_state.real_goals = [0,0]
-        st.session_state.pred_goals = [0,0]
+        reset_game_state()
         st.session_state.gameClient.gameId = 0
 
     # If no button click, but page rerun: show previous model
@@ -128,6 +292,11 @@ with st.sidebar:
     else: 
         st.write('Waiting on **Get Model** button press...')
 
+    auto_refresh = st.checkbox('Auto refresh live games', value=False)
+    refresh_interval = st.slider('Refresh interval (seconds)', min_value=5, max_value=60, value=15)
+    if not auto_refresh:
+        st.session_state.live = False
+
     
 
 with st.container():
@@ -137,9 +306,8 @@ with st.container():
     
     # Reinitialize session state objects if game_id changes
     if game_id != st.session_state.gameClient.gameId: 
-        st.session_state.stored_df = None
-        st.session_state.real_goals = [0,0]
-        st.session_state.pred_goals = [0,0]
+        drop_pending_update()
+        reset_game_state()
 
     pred_button = st.button('Ping Game')
     if pred_button:
@@ -148,75 +316,28 @@ with st.container():
             st.write(':red[Please download model first!]')
         else: 
             st.write(f'**The current game ID is {game_id}!**') 
+            st.session_state.live = auto_refresh
         
 
 st.write('')
 st.write('')
 
+# The game is (re)loaded on a button press, or on every run while it is refreshed automatically
+ping = (pred_button or st.session_state.live) and st.session_state.model_downloaded
+if ping:
+    # Start fetching the new events in the background, the current state is rendered meanwhile
+    future = start_update(game_id, st.session_state.model)
+
               
 with st.container():
     # TODO: Add Game info and predictions
 
     st.header(f"Game goal predictions")
-    if pred_button and st.session_state.model_downloaded:
-        
-        # Get dataframe of new events
-        df_MODEL = st.session_state.gameClient.process_query(game_id, model_name=st.session_state.model) 
-        
-        # If there are new events: 
-        if df_MODEL is not None: 
-            # Make predictions on events 
-            pred_MODEL = st.session_state.servingClient.predict(df_MODEL)
-            
-            df = pd.DataFrame(df_MODEL, columns=st.session_state.servingClient.features) 
-            df = df.reset_index(drop=True)
-            df['Model Output'] = pred_MODEL
-
-            # Calculate game actual goals and goal predictions 
-            real_goals, teams_A_H, teams_full = st.session_state.gameClient.get_scores()
-            pred_goals = calculate_game_goals(df_MODEL, pred_MODEL, teams_A_H) 
-             
-            for i in range(len(teams_A_H)):
-                st.session_state.pred_goals[i] += pred_goals[i]
-                st.session_state.real_goals[i] = real_goals[i] 
-            st.session_state.teams = teams_A_H
-            st.session_state.teams_full = teams_full
-
-        else: 
-            df = None
-            st.write(':red[No new events!]')
-        
-        # Comparing current and previous gameId:
-        if game_id == st.session_state.gameClient.gameId: 
-            # st.write('Concat!')
-            df = pd.concat([st.session_state.stored_df, df], ignore_index=True)
-            st.session_state.stored_df = df 
-        else: 
-            st.session_state.stored_df = df 
-        
-
-        # Getting Game info:
-        st.subheader(f"{st.session_state.teams_full[0]} VS {st.session_state.teams_full[1]}")
-
-        period, periodTimeRemaining = st.session_state.gameClient.get_period_info()
-        if st.session_state.gameClient.game_ended: 
-            st.write('**Game ended!**')
-            st.write(f'Game end at: **Period:** {period}  --  **Period time remaining:** {periodTimeRemaining}')  
-        else: 
-            st.write('**Game live!**')        
-            st.write(f'**Period:** {period}  --  **Period time remaining:** {periodTimeRemaining}')      
-
-
-        # Display game goal predictions and info:
-        col1, col2 = st.columns(2)
-        pred_goals_round = np.round(st.session_state.pred_goals, decimals=1)
-
-        delta1 = float(np.round(pred_goals_round[0] - st.session_state.real_goals[0], decimals=1))
-        delta2 = float(np.round(pred_goals_round[1] - st.session_state.real_goals[1], decimals=1))
-        col1.metric(label=f"**{st.session_state.teams[0]}** xG (actual)", value=f"{pred_goals_round[0]} ({st.session_state.real_goals[0]})", delta=delta1)
-        col2.metric(label=f"**{st.session_state.teams[1]}** xG (actual)", value=f"{pred_goals_round[1]} ({st.session_state.real_goals[1]})", delta=delta2)
-
-    else:
+    game_info = st.empty()
+    if ping and st.session_state.stored_chunks:
+        with game_info.container():
+            render_game_info()
+    elif not ping:
         st.write('Waiting on **Ping Game** button press...')
     
     st.write('')
@@ -224,8 +345,30 @@ with st.container():
 
     # Display feature values and model predictions per game event:
     st.header(f"Game data and corresponding model predictions")
-    if pred_button and st.session_state.model_downloaded:
-        st.write(st.session_state.stored_df)
+    if ping:
+        # The rows received before this run are rendered once, the new rows of each refresh
+        # are appended below them as their own table
+        table_area = st.container()
+        chunks = st.session_state.stored_chunks
+        if chunks:
+            table_area.dataframe(pd.concat(chunks, ignore_index=True))
     else:
         st.write('Waiting on **Ping Game** button press...')
 
+
+while ping:
+    update = finish_update(future)
+
+    # Only the new rows are sent to the browser
+    with game_info.container():
+        render_game_info(new_events=update['df'] is not None)
+    if update['df'] is not None:
+        table_area.dataframe(update['df'])
+
+    if not st.session_state.live or st.session_state.gameClient.game_ended:
+        st.session_state.live = False
+        break
+
+    # Any interaction with the page stops this loop and reruns the script
+    time.sleep(refresh_interval)
+    future = start_update(game_id, st.session_state.model)